@@ -3,6 +3,7 @@ import re
 import sys
 import warnings
 from collections import deque
+from contextvars import ContextVar
 from functools import partial
 from inspect import isclass
 from inspect import isfunction
@@ -13,6 +14,7 @@ from inspect import ismethoddescriptor
 from inspect import ismodule
 from inspect import isroutine
 from logging import getLogger
+from weakref import ref
 
 from .utils import PY3
 from .utils import Sentinel
@@ -21,6 +23,12 @@ from .utils import force_bind
 from .utils import logf
 from .utils import make_method_matcher
 from .utils import mimic
+from .utils import register_after_fork
+
+try:
+    from functools import cached_property
+except ImportError:
+    cached_property = None
 
 try:
     from types import InstanceType
@@ -50,7 +58,7 @@ try:
 except ImportError:
     isasyncfunction = None
 
-__all__ = 'weave', 'Aspect', 'Proceed', 'Return', 'ALL_METHODS', 'NORMAL_METHODS', 'ABSOLUTELY_ALL_METHODS'
+__all__ = 'weave', 'Aspect', 'Proceed', 'Return', 'WeavePlan', 'ALL_METHODS', 'NORMAL_METHODS', 'ABSOLUTELY_ALL_METHODS'
 __version__ = '2.0.0'
 
 logger = getLogger(__name__)
@@ -120,6 +128,9 @@ class Aspect(object):
     Args:
         advising_function (generator function): A generator function that yields :ref:`advices`.
         bind (bool): A convenience flag so you can access the cutpoint function (you'll get it as an argument).
+        outermost (bool): If ``True`` the advice only runs for the outermost call - if a cutpoint (of the same aspect) is
+            called again while the advice is active (eg: recursion) the cutpoint is called directly. The nesting is
+            tracked per thread and per asyncio task. Has no effect on generator cutpoints.
 
     Usage::
 
@@ -155,23 +166,63 @@ class Aspect(object):
 
     """
 
-    __slots__ = 'advising_function', 'bind'
+    __slots__ = 'advising_function', 'bind', '_outermost'
 
-    def __new__(cls, advising_function=UNSPECIFIED, bind=False):
+    def __new__(cls, advising_function=UNSPECIFIED, bind=False, outermost=False):
         if advising_function is UNSPECIFIED:
-            return partial(cls, bind=bind)
+            return partial(cls, bind=bind, outermost=outermost)
         else:
-            self = super(Aspect, cls).__new__(cls)
-            self.__init__(advising_function, bind)
-            return self
+            return super(Aspect, cls).__new__(cls)
 
-    def __init__(self, advising_function, bind=False):
+    def __init__(self, advising_function, bind=False, outermost=False):
         if not isgeneratorfunction(advising_function):
             raise ExpectedGeneratorFunction("advising_function %s must be a generator function." % advising_function)
         self.advising_function = advising_function
         self.bind = bind
+        self._outermost = ContextVar('aspectlib.outermost', default=False) if outermost else None
 
     def __call__(self, cutpoint_function):
+        wrapper = self._make_wrapper(cutpoint_function)
+        # subclasses that don't call Aspect.__init__ don't have it set
+        if getattr(self, '_outermost', None) is None or isgeneratorfunction(cutpoint_function):
+            return wrapper
+        elif isasyncfunction is not None and isasyncfunction(cutpoint_function):
+            if iscoroutinefunction(cutpoint_function):
+                return self._make_outermost_coroutine_wrapper(wrapper, cutpoint_function)
+            else:
+                return wrapper
+        else:
+            return self._make_outermost_function_wrapper(wrapper, cutpoint_function)
+
+    def _make_outermost_coroutine_wrapper(self, wrapper, cutpoint_function):
+        active = self._outermost
+
+        async def outermost_coroutine_wrapper(*args, **kwargs):
+            if active.get():
+                return await cutpoint_function(*args, **kwargs)
+            token = active.set(True)
+            try:
+                return await wrapper(*args, **kwargs)
+            finally:
+                active.reset(token)
+
+        return mimic(outermost_coroutine_wrapper, cutpoint_function)
+
+    def _make_outermost_function_wrapper(self, wrapper, cutpoint_function):
+        active = self._outermost
+
+        def outermost_function_wrapper(*args, **kwargs):
+            if active.get():
+                return cutpoint_function(*args, **kwargs)
+            token = active.set(True)
+            try:
+                return wrapper(*args, **kwargs)
+            finally:
+                active.reset(token)
+
+        return mimic(outermost_function_wrapper, cutpoint_function)
+
+    def _make_wrapper(self, cutpoint_function):
         if isasyncfunction is not None and isasyncfunction(cutpoint_function):
             assert isasyncgenfunction(cutpoint_function) or iscoroutinefunction(cutpoint_function)
 
@@ -323,6 +374,140 @@ class Rollback(object):
     rollback = __call__ = __exit__
 
 
+class _ForkAwareRollback(Rollback):
+    """
+    Rollback for weaves made with the ``after_fork`` option. Keeps what's needed to redo the weave in a forked child.
+    """
+
+    __slots__ = 'target', 'aspects', 'options', 'after_fork'
+
+    def __init__(self, rollback, target, aspects, options, after_fork):
+        super(_ForkAwareRollback, self).__init__(rollback)
+        self.target = target
+        self.aspects = aspects
+        self.options = options
+        self.after_fork = after_fork
+        _fork_aware_weaves.append(self)
+
+    def __exit__(self, *_):
+        if self in _fork_aware_weaves:
+            _fork_aware_weaves.remove(self)
+        super(_ForkAwareRollback, self).__exit__()
+
+    rollback = __call__ = __exit__
+
+
+_fork_aware_weaves = []
+
+
+def _after_fork_weaves():
+    # undo everything first (newest first), otherwise reapplying a weave could get clobbered by an older weave's rollback
+    for entanglement in reversed(_fork_aware_weaves):
+        Rollback.__exit__(entanglement)
+    for entanglement in list(_fork_aware_weaves):
+        if entanglement.after_fork == 'reapply':
+            logdebug("@ reapplying weave on %r after fork.", entanglement.target)
+            entanglement.merge(weave(entanglement.target, entanglement.aspects, **entanglement.options))
+        else:
+            _fork_aware_weaves.remove(entanglement)
+
+
+register_after_fork(_after_fork_weaves)
+
+
+class WeavePlan(object):
+    """
+    A picklable list of weaves (dotted targets and aspect factories) that can be applied again in other processes, like
+    the workers of a ``multiprocessing.Pool`` or ``concurrent.futures.ProcessPoolExecutor`` (weaves made in the parent
+    don't exist in workers started with the `spawn` or `forkserver` methods).
+
+    Args:
+        weaves (list): Initial list of ``(target, aspect_factory, options)`` tuples.
+
+    The aspect factories are called (without arguments) in each process to make the aspects, thus they must be picklable
+    (eg: module-level functions or ``functools.partial`` objects). Weaves that are already applied in the process (eg:
+    inherited by workers started with the `fork` method) are not applied again. Usage::
+
+        >>> from concurrent.futures import ProcessPoolExecutor
+        >>> from aspectlib.debug import log
+        >>> plan = WeavePlan()
+        >>> with plan.weave('mymod.func', log):
+        ...     executor = ProcessPoolExecutor(**plan.pool_options())
+        ...     executor.shutdown()
+    """
+
+    __slots__ = 'weaves'
+
+    def __init__(self, weaves=()):
+        self.weaves = list(weaves)
+
+    def weave(self, target, aspect_factory, **options):
+        """
+        Weaves `target` (in the current process) and adds it to the plan. The target must be importable (a dotted
+        string, a module or a module-level function or class).
+
+        :returns: An :obj:`aspectlib.Rollback` object. The rollback also removes the weave from the plan.
+        """
+        entry = _dotted_name(target), aspect_factory, options
+        entanglement = _apply_plan_entry(entry)
+        self.weaves.append(entry)
+        return Rollback([entanglement, lambda: self.weaves.remove(entry)])
+
+    def apply(self):
+        """
+        Applies the weaves in the plan that aren't already applied in this process.
+
+        :returns: An :obj:`aspectlib.Rollback` object.
+        """
+        logdebug("applying weave plan %r", self.weaves)
+        return Rollback([_apply_plan_entry(entry) for entry in self.weaves if entry not in _live_plan_weaves])
+
+    __call__ = apply
+
+    def pool_options(self, initializer=None, initargs=()):
+        """
+        Returns the ``initializer`` and ``initargs`` keyword arguments for ``multiprocessing.Pool`` or
+        ``concurrent.futures.ProcessPoolExecutor`` that apply the plan in every worker (before your own `initializer`).
+        """
+        return dict(initializer=_apply_weave_plan, initargs=(self, initializer, initargs))
+
+
+_live_plan_weaves = []
+
+
+def _apply_plan_entry(entry):
+    target, aspect_factory, options = entry
+    entanglement = weave(target, aspect_factory(), **options)
+    _live_plan_weaves.append(entry)
+    return Rollback([entanglement, lambda: _live_plan_weaves.remove(entry)])
+
+
+def _after_fork_weave_plans():
+    # the dropped weaves are gone in the child, the others were inherited
+    _live_plan_weaves[:] = [entry for entry in _live_plan_weaves if entry[2].get('after_fork') != 'drop']
+
+
+register_after_fork(_after_fork_weave_plans)
+
+
+def _apply_weave_plan(plan, initializer=None, initargs=()):
+    plan.apply()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _dotted_name(target):
+    if isinstance(target, basestring):
+        return target
+    elif ismodule(target):
+        return target.__name__
+    elif isclass(target) or isfunction(target):
+        name = '%s.%s' % (target.__module__, target.__qualname__)
+        if '<' not in name:
+            return name
+    raise UnsupportedType("Can't make an importable name for %r. Use a dotted string instead." % (target,))
+
+
 class ObjectBag(object):
     def __init__(self):
         self._objects = {}
@@ -391,6 +576,21 @@ def weave(target, aspects, **options):
             ``__init__`` is called. *Only available for classes*.
         methods (list or regex or string):
             Methods from target to patch. *Only available for classes*
+        after_fork (string):
+            What to do with the weave in a child process after ``os.fork()``: ``"drop"`` to rollback the weave in the
+            child or ``"reapply"`` to rollback and weave again (so fresh wrappers are made in the child). By default the
+            weave is left as is (it's inherited from the parent).
+        properties (bool):
+            If ``True``, the getters, setters and deleters of properties (and ``functools.cached_property`` functions) are
+            weaved too. *Only available for classes*
+        memoize_properties (bool):
+            Like ``properties`` but the weaved properties also cache the getter's result on the instance. The cached
+            value is dropped when the property is set or deleted, or via ``Class.attribute.invalidate(instance)``.
+            *Only available for classes*
+        shared (bool):
+            If ``True`` the instance's class is patched only once (one dispatcher for each method) and just the woven
+            instances are routed through their aspects. Makes weaving lots of instances of the same class cheap. *Only available for
+            instances*.
 
     Returns:
         aspectlib.Rollback: An object that can rollback the patches.
@@ -415,6 +615,12 @@ def weave(target, aspects, **options):
     assert target, "Can't weave falsy value %r." % target
     logdebug("weave (target=%s, aspects=%s, **options=%s)", target, aspects, options)
 
+    after_fork = options.pop('after_fork', None)
+    if after_fork is not None:
+        if after_fork not in ('drop', 'reapply'):
+            raise ValueError("Invalid after_fork option %r. Must be 'drop' or 'reapply'." % (after_fork,))
+        return _ForkAwareRollback(weave(target, aspects, **options), target, aspects, options, after_fork)
+
     bag = options.setdefault('bag', ObjectBag())
 
     if isinstance(target, (list, tuple)):
@@ -508,7 +714,61 @@ def _rewrap_method(func, klass, aspect):
         return _checked_apply(aspect, func)
 
 
-def weave_instance(instance, aspect, methods=NORMAL_METHODS, lazy=False, bag=BrokenBag, **options):
+def _is_property(obj):
+    return isinstance(obj, property) or cached_property is not None and isinstance(obj, cached_property)
+
+
+class _MemoizedProperty(property):
+    """
+    Property that caches the getter's result in the instance's ``__dict__``. The cached value is dropped when the property
+    is set or deleted, or when ``invalidate(instance)`` is called.
+    """
+
+    name = None
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        cache = getattr(instance, '__dict__', None)
+        if cache is None:
+            return super(_MemoizedProperty, self).__get__(instance, owner)
+        try:
+            return cache[self.name]
+        except KeyError:
+            value = cache[self.name] = super(_MemoizedProperty, self).__get__(instance, owner)
+            return value
+
+    def __set__(self, instance, value):
+        super(_MemoizedProperty, self).__set__(instance, value)
+        self.invalidate(instance)
+
+    def __delete__(self, instance):
+        super(_MemoizedProperty, self).__delete__(instance)
+        self.invalidate(instance)
+
+    def invalidate(self, instance):
+        getattr(instance, '__dict__', {}).pop(self.name, None)
+
+
+def _rewrap_property(prop, klass, name, aspect, memoize=False):
+    if cached_property is not None and isinstance(prop, cached_property):
+        woven = cached_property(_checked_apply(aspect, prop.func))
+        woven.__set_name__(klass, prop.attrname or name)
+        return woven
+    woven = prop
+    if prop.fget is not None:
+        woven = woven.getter(_checked_apply(aspect, prop.fget))
+    if prop.fset is not None:
+        woven = woven.setter(_checked_apply(aspect, prop.fset))
+    if prop.fdel is not None:
+        woven = woven.deleter(_checked_apply(aspect, prop.fdel))
+    if memoize:
+        woven = _MemoizedProperty(woven.fget, woven.fset, woven.fdel, prop.__doc__)
+        woven.name = name
+    return woven
+
+
+def weave_instance(instance, aspect, methods=NORMAL_METHODS, lazy=False, bag=BrokenBag, shared=False, **options):
     """
     Low-level weaver for instances.
 
@@ -519,6 +779,12 @@ def weave_instance(instance, aspect, methods=NORMAL_METHODS, lazy=False, bag=Bro
     if bag.has(instance):
         return Nothing
 
+    if shared:
+        try:
+            return _weave_instance_shared(instance, aspect, methods)
+        except TypeError as exc:
+            logdebug("  can't use shared weaving for %r (%s), falling back to per-instance weaving.", instance, exc)
+
     entanglement = Rollback()
     method_matches = make_method_matcher(methods)
     logdebug("weave_instance (module=%r, aspect=%s, methods=%s, lazy=%s, **options=%s)", instance, aspect, methods, lazy, options)
@@ -540,6 +806,124 @@ def weave_instance(instance, aspect, methods=NORMAL_METHODS, lazy=False, bag=Bro
     return entanglement
 
 
+_shared_dispatchers = {}
+
+
+class _SharedInstanceDispatcher(object):
+    """
+    Dispatcher installed on a class attribute by ``weave_instance(..., shared=True)``. There's one for each class and
+    attribute, no matter how many aspects or instances are woven. Each woven instance (matched by identity) is routed
+    through its aspects (in the order they were woven), the other instances go straight to the original function.
+    """
+
+    __slots__ = 'klass', 'attr', 'original', 'owned', 'entries', 'routes', 'chains'
+
+    def __init__(self, klass, attr, original):
+        self.klass = klass
+        self.attr = attr
+        self.original = original
+        self.owned = attr in klass.__dict__
+        self.entries = {}  # aspect key -> (aspect, {id(instance): weave count})
+        self.routes = {}  # id(instance) -> [weakref to instance, tuple of aspect keys]
+        self.chains = {}
+
+        routes = self.routes
+        chains = self.chains
+
+        def shared_instance_dispatcher(instance, *args, **kwargs):
+            item = routes.get(id(instance))
+            if item is None or item[0]() is not instance:
+                return original(instance, *args, **kwargs)
+            route = item[1]
+            woven = chains.get(route)
+            if woven is None:
+                woven = chains[route] = self._make_chain(route)
+            return woven.__get__(instance, type(instance))(*args, **kwargs)
+
+        logdebug("@ patching attribute %r (shared for instances of %s, original: %r).", attr, klass.__name__, original)
+        setattr(klass, attr, mimic(shared_instance_dispatcher, original))
+
+    def _make_chain(self, route):
+        woven = self.original
+        for key in route:
+            woven = _checked_apply(self.entries[key][0], woven)
+        return woven
+
+    def _forget(self, ident, _):
+        self.routes.pop(ident, None)
+        for _, counts in self.entries.values():
+            counts.pop(ident, None)
+
+    def add(self, key, aspect, instance):
+        ident = id(instance)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = aspect, {}
+        counts = entry[1]
+        count = counts.get(ident, 0)
+        counts[ident] = count + 1
+        if not count:
+            item = self.routes.get(ident)
+            if item is None:
+                item = self.routes[ident] = [ref(instance, partial(self._forget, ident)), ()]
+            item[1] += (key,)
+
+    def remove(self, key, instance):
+        """
+        Removes one weave of ``instance`` with ``key``. Returns ``True`` if the original was restored (no weaves left).
+        """
+        ident = id(instance)
+        counts = self.entries[key][1]
+        count = counts.pop(ident) - 1
+        if count:
+            counts[ident] = count
+            return False
+        item = self.routes[ident]
+        item[1] = tuple(item_key for item_key in item[1] if item_key != key)
+        if not item[1]:
+            del self.routes[ident]
+        if not counts:
+            del self.entries[key]
+            for route in [route for route in self.chains if key in route]:
+                del self.chains[route]
+        if self.entries:
+            return False
+        logdebug("@ restoring attribute %r on %s (original: %r).", self.attr, self.klass.__name__, self.original)
+        if self.owned:
+            setattr(self.klass, self.attr, self.original)
+        else:
+            delattr(self.klass, self.attr)
+        return True
+
+
+def _weave_instance_shared(instance, aspect, methods):
+    ref(instance)  # raises TypeError early (before patching anything) if the instance can't be a member
+    klass = type(instance)
+    key = tuple(aspect) if isinstance(aspect, (list, tuple)) else aspect
+    method_matches = make_method_matcher(methods)
+    dispatchers = []
+    seen = set()
+    for sklass in _find_super_classes(klass):
+        for attr, func in sklass.__dict__.items():
+            if attr in seen or not method_matches(attr):
+                continue
+            seen.add(attr)
+            dispatcher = _shared_dispatchers.get((klass, attr))
+            if dispatcher is None and isfunction(func):
+                dispatcher = _shared_dispatchers[klass, attr] = _SharedInstanceDispatcher(klass, attr, func)
+            if dispatcher is not None:
+                dispatcher.add(key, aspect, instance)
+                dispatchers.append(dispatcher)
+    logdebug("weave_instance (instance=%r) routed via shared weaving for %s", instance, klass)
+
+    def rollback():
+        for dispatcher in dispatchers:
+            if dispatcher.remove(key, instance):
+                del _shared_dispatchers[dispatcher.klass, dispatcher.attr]
+
+    return Rollback(rollback)
+
+
 def weave_module(module, aspect, methods=NORMAL_METHODS, lazy=False, bag=BrokenBag, **options):
     """
     Low-level weaver for "whole module weaving".
@@ -571,13 +955,25 @@ def weave_module(module, aspect, methods=NORMAL_METHODS, lazy=False, bag=BrokenB
 
 
 def weave_class(
-    klass, aspect, methods=NORMAL_METHODS, subclasses=True, lazy=False, owner=None, name=None, aliases=True, bases=True, bag=BrokenBag
+    klass,
+    aspect,
+    methods=NORMAL_METHODS,
+    subclasses=True,
+    lazy=False,
+    owner=None,
+    name=None,
+    aliases=True,
+    bases=True,
+    bag=BrokenBag,
+    properties=False,
+    memoize_properties=False,
 ):
     """
     Low-level weaver for classes.
 
     .. warning:: You should not use this directly.
     """
+    properties = properties or memoize_properties
     assert isclass(klass), "Can't weave %r. Must be a class." % klass
 
     if bag.has(klass):
@@ -586,7 +982,7 @@ def weave_class(
     entanglement = Rollback()
     method_matches = make_method_matcher(methods)
     logdebug(
-        "weave_class (klass=%r, methods=%s, subclasses=%s, lazy=%s, owner=%s, name=%s, aliases=%s, bases=%s)",
+        "weave_class (klass=%r, methods=%s, subclasses=%s, lazy=%s, owner=%s, name=%s, aliases=%s, bases=%s, properties=%s)",
         klass,
         methods,
         subclasses,
@@ -595,6 +991,7 @@ def weave_class(
         name,
         aliases,
         bases,
+        properties,
     )
 
     if subclasses and hasattr(klass, '__subclasses__'):
@@ -603,7 +1000,18 @@ def weave_class(
             logdebug("~ weaving subclasses: %s", sub_targets)
         for sub_class in sub_targets:
             if not issubclass(sub_class, Fabric):
-                entanglement.merge(weave_class(sub_class, aspect, methods=methods, subclasses=subclasses, lazy=lazy, bag=bag))
+                entanglement.merge(
+                    weave_class(
+                        sub_class,
+                        aspect,
+                        methods=methods,
+                        subclasses=subclasses,
+                        lazy=lazy,
+                        bag=bag,
+                        properties=properties,
+                        memoize_properties=memoize_properties,
+                    )
+                )
     if lazy:
 
         def __init__(self, *args, **kwargs):
@@ -617,7 +1025,10 @@ def weave_class(
         wrappers = {'__init__': _checked_apply(aspect, __init__) if method_matches('__init__') else __init__}
         for attr, func in klass.__dict__.items():
             if method_matches(attr):
-                if ismethoddescriptor(func):
+                if _is_property(func):
+                    if properties:
+                        wrappers[attr] = _rewrap_property(func, klass, attr, aspect, memoize_properties)
+                elif ismethoddescriptor(func):
                     wrappers[attr] = _rewrap_method(func, klass, aspect)
 
         logdebug(" * creating subclass with attributes %r", wrappers)
@@ -630,7 +1041,10 @@ def weave_class(
         original = {}
         for attr, func in klass.__dict__.items():
             if method_matches(attr):
-                if isroutine(func):
+                if properties and _is_property(func):
+                    logdebug("@ patching property %r (original: %r).", attr, func)
+                    setattr(klass, attr, _rewrap_property(func, klass, attr, aspect, memoize_properties))
+                elif isroutine(func) and not _is_property(func):
                     logdebug("@ patching attribute %r (original: %r).", attr, func)
                     setattr(klass, attr, _rewrap_method(func, klass, aspect))
                 else:
@@ -643,7 +1057,10 @@ def weave_class(
                 if sklass is not object:
                     for attr, func in sklass.__dict__.items():
                         if method_matches(attr) and attr not in original and attr not in super_original:
-                            if isroutine(func):
+                            if properties and _is_property(func):
+                                logdebug("@ patching property %r (from superclass: %s, original: %r).", attr, sklass.__name__, func)
+                                setattr(klass, attr, _rewrap_property(func, klass, attr, aspect, memoize_properties))
+                            elif isroutine(func) and not _is_property(func):
                                 logdebug("@ patching attribute %r (from superclass: %s, original: %r).", attr, sklass.__name__, func)
                                 setattr(klass, attr, _rewrap_method(func, sklass, aspect))
                             else:
@@ -1,16 +1,47 @@
+import asyncio
+import random
+import threading
 import time
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from contextvars import ContextVar
+from contextvars import copy_context
+from functools import partial
+from importlib import import_module
+from inspect import isasyncgenfunction
+from inspect import isawaitable
+from inspect import iscoroutinefunction
+from inspect import isfunction
+from inspect import isgeneratorfunction
 from logging import getLogger
+from weakref import WeakKeyDictionary
+from weakref import ref
 
 from aspectlib import Aspect
+from aspectlib import Return
+from aspectlib import mimic
+from aspectlib.utils import register_after_fork
+from aspectlib.utils import repr_ex
 
 logger = getLogger(__name__)
 
 
-def retry(func=None, retries=5, backoff=None, exceptions=(IOError, OSError, EOFError), cleanup=None, sleep=time.sleep):
+def retry(func=None, retries=5, backoff=None, exceptions=(IOError, OSError, EOFError), cleanup=None, sleep=time.sleep,
+          budget=None):
     """
     Decorator that retries the call ``retries`` times if ``func`` raises ``exceptions``. Can use a ``backoff`` function
     to sleep till next retry.
 
+    A :obj:`RetryBudget` can be given as ``budget`` (and shared by many decorated functions) to limit the retries
+    overall: if it doesn't have a token for a retry the exception is raised right away.
+
+    Coroutine functions are retried without blocking the event loop: the default ``sleep`` is replaced with
+    :obj:`asyncio.sleep`, and a ``sleep`` or ``cleanup`` that returns an awaitable gets awaited. Cancelling the task
+    during the backoff stops the retrying (cancellation is never retried).
+
     Example::
 
         >>> should_fail = lambda foo=[1,2,3]: foo and foo.pop()
@@ -34,6 +65,17 @@ def retry(func=None, retries=5, backoff=None, exceptions=(IOError, OSError, EOFE
         ...
         OSError: Tough luck!
 
+    Coroutines::
+
+        >>> import asyncio
+        >>> @retry(backoff=0.01)
+        ... async def flaky_coro():
+        ...     if should_fail():
+        ...         raise OSError('Tough luck!')
+        ...     return "Success!"
+        ...
+        >>> asyncio.run(flaky_coro())
+        'Success!'
     """
 
     @Aspect(bind=True)
@@ -45,19 +87,60 @@ def retry(func=None, retries=5, backoff=None, exceptions=(IOError, OSError, EOFE
                 yield
                 break
             except exceptions as exc:
-                if count == retries:
+                if count == retries or _budget_exhausted(budget, cutpoint, args, kwargs, exc):
                     raise
-                if not backoff:
-                    timeout = 0
-                elif isinstance(backoff, (int, float)):
-                    timeout = backoff
-                else:
-                    timeout = backoff(count)
+                timeout = _backoff_timeout(backoff, count)
                 logger.exception("%s(%s, %s) raised exception %s. %s retries left. Sleeping %s secs.",
                                  cutpoint.__name__, args, kwargs, exc, retries - count, timeout)
                 sleep(timeout)
 
-    return retry_aspect if func is None else retry_aspect(func)
+    def retry_coroutine(cutpoint):
+        async_sleep = asyncio.sleep if sleep is time.sleep else sleep
+
+        async def retry_coroutine_wrapper(*args, **kwargs):
+            for count in range(retries + 1):
+                try:
+                    if count and cleanup:
+                        result = cleanup(*args, **kwargs)
+                        if isawaitable(result):
+                            await result
+                    return await cutpoint(*args, **kwargs)
+                except exceptions as exc:
+                    if count == retries or _budget_exhausted(budget, cutpoint, args, kwargs, exc):
+                        raise
+                    timeout = _backoff_timeout(backoff, count)
+                    logger.exception("%s(%s, %s) raised exception %s. %s retries left. Sleeping %s secs.",
+                                     cutpoint.__name__, args, kwargs, exc, retries - count, timeout)
+                    result = async_sleep(timeout)
+                    if isawaitable(result):
+                        await result
+
+        return mimic(retry_coroutine_wrapper, cutpoint)
+
+    def retry_decorator(cutpoint):
+        if iscoroutinefunction(cutpoint):
+            return retry_coroutine(cutpoint)
+        else:
+            return retry_aspect(cutpoint)
+
+    return retry_decorator if func is None else retry_decorator(func)
+
+
+def _budget_exhausted(budget, cutpoint, args, kwargs, exc):
+    if budget is None or budget.acquire():
+        return False
+    logger.error("%s(%s, %s) raised exception %s. Retry budget exhausted, not retrying.",
+                 cutpoint.__name__, args, kwargs, exc)
+    return True
+
+
+def _backoff_timeout(backoff, count):
+    if not backoff:
+        return 0
+    elif isinstance(backoff, (int, float)):
+        return backoff
+    else:
+        return backoff(count)
 
 
 def exponential_backoff(count):
@@ -88,3 +171,1219 @@ def flat_backoff(count):
 
 
 retry.flat_backoff = flat_backoff
+
+
+def full_jitter_backoff(count, base=1, cap=60):
+    """
+    Wait a random amount between 0 and ``2**N`` seconds (``base * 2**N`` but no more than ``cap``). Use
+    :obj:`functools.partial` to change ``base`` or ``cap``.
+    """
+    return random.uniform(0, min(cap, base * 2 ** count))
+
+
+retry.full_jitter_backoff = full_jitter_backoff
+
+
+def equal_jitter_backoff(count, base=1, cap=60):
+    """
+    Wait half of ``2**N`` seconds plus a random amount up to the other half (``base * 2**N`` but no more than ``cap``).
+    """
+    timeout = min(cap, base * 2 ** count)
+    return timeout / 2 + random.uniform(0, timeout / 2)
+
+
+retry.equal_jitter_backoff = equal_jitter_backoff
+
+_previous_backoff = ContextVar('aspectlib.contrib.previous_backoff', default=None)
+
+
+def decorrelated_jitter_backoff(count, base=1, cap=60):
+    """
+    Wait a random amount between ``base`` and 3 times the previous wait (but no more than ``cap``). The previous wait
+    is tracked for each thread and asyncio task.
+    """
+    previous = _previous_backoff.get() if count else None
+    timeout = min(cap, random.uniform(base, (previous or base) * 3))
+    _previous_backoff.set(timeout)
+    return timeout
+
+
+retry.decorrelated_jitter_backoff = decorrelated_jitter_backoff
+
+
+class RetryBudget(object):
+    """
+    A token bucket that limits retries: it holds up to ``capacity`` tokens and gets ``rate`` tokens per second back.
+    Each retry takes a token. Share one between many :obj:`retry` decorated functions so a failing dependency doesn't
+    get a storm of retries.
+
+    Example::
+
+        >>> budget = RetryBudget(capacity=2, rate=0)
+        >>> @retry(budget=budget)
+        ... def bad_func():
+        ...     raise OSError('Tough luck!')
+        ...
+        >>> bad_func()
+        Traceback (most recent call last):
+        ...
+        OSError: Tough luck!
+        >>> budget.tokens
+        0
+    """
+
+    def __init__(self, capacity=10, rate=1.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the lock might have been held by another thread
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Returns ``True`` if the tokens were taken, ``False`` if there aren't enough.
+        """
+        with self.lock:
+            now = self.clock()
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            else:
+                return False
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised by :obj:`CircuitBreaker` instead of calling the function while the circuit is open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Aspect that stops calling a failing dependency for a while. The circuit is:
+
+    * ``"closed"`` - calls go through and their failures are counted in a rolling window of ``window`` seconds. When at
+      least ``minimum_calls`` calls were made in the window and ``failure_ratio`` of them failed the circuit opens.
+    * ``"open"`` - calls fail right away with :obj:`CircuitOpenError`. After ``reset_timeout`` seconds the circuit
+      becomes half-open.
+    * ``"half-open"`` - only ``half_open_calls`` trial calls go through (the others fail with :obj:`CircuitOpenError`).
+      If they all succeed the circuit closes, if one fails it opens again.
+
+    Only the ``exceptions`` count as failures. Use the same instance for many functions (eg: weave a whole class with
+    it) to have them share the state. Works with functions, generators and coroutines.
+
+    Example::
+
+        >>> breaker = CircuitBreaker(minimum_calls=2, failure_ratio=0.5)
+        >>> @breaker
+        ... def bad_func():
+        ...     raise OSError('Tough luck!')
+        ...
+        >>> for _ in range(3):
+        ...     try:
+        ...         bad_func()
+        ...     except Exception as exc:
+        ...         print(repr(exc))
+        OSError('Tough luck!')
+        OSError('Tough luck!')
+        CircuitOpenError('bad_func: circuit is open')
+        >>> breaker.state
+        'open'
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_ratio=0.5, minimum_calls=10, window=60, buckets=10, reset_timeout=30, half_open_calls=1,
+                 exceptions=(Exception,), clock=time.monotonic):
+        self.failure_ratio = failure_ratio
+        self.minimum_calls = minimum_calls
+        self.bucket_width = window / buckets
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.exceptions = exceptions
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buckets = [[None, 0, 0] for _ in range(buckets)]  # [bucket id, calls, failures]
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.trials = self.trial_successes = 0
+        self.aspect = Aspect(bind=True)(self.advising_function)
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the lock might have been held by another thread, and the trial calls of the other threads never finish
+        self.lock = threading.Lock()
+        self.trials = self.trial_successes = 0
+
+    def __call__(self, cutpoint_function):
+        return self.aspect(cutpoint_function)
+
+    def reset(self):
+        """
+        Close the circuit and forget the past calls.
+        """
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        for bucket in self.buckets:
+            bucket[:] = None, 0, 0
+        self.state = self.CLOSED
+        self.opened_at = None
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+
+    def _before_call(self, cutpoint):
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError('%s: circuit is open' % cutpoint.__name__)
+                self.state = self.HALF_OPEN
+                self.trials = self.trial_successes = 0
+            if self.state == self.HALF_OPEN:
+                if self.trials >= self.half_open_calls:
+                    raise CircuitOpenError('%s: circuit is half-open and has enough trial calls' % cutpoint.__name__)
+                self.trials += 1
+                return True
+            return False
+
+    def _bucket(self, now):
+        # must be called with the lock held
+        bucket_id = int(now // self.bucket_width)
+        bucket = self.buckets[bucket_id % len(self.buckets)]
+        if bucket[0] != bucket_id:
+            bucket[:] = bucket_id, 0, 0
+        return bucket
+
+    def _record_success(self, trial):
+        if trial:
+            with self.lock:
+                if self.state == self.HALF_OPEN:
+                    self.trial_successes += 1
+                    if self.trial_successes >= self.half_open_calls:
+                        self._close()
+        else:
+            now = self.clock()
+            bucket_id = int(now // self.bucket_width)
+            bucket = self.buckets[bucket_id % len(self.buckets)]
+            if bucket[0] == bucket_id:
+                # no lock - a lost increment under contention only makes the failure ratio a bit higher
+                bucket[1] += 1
+            else:
+                with self.lock:
+                    self._bucket(now)[1] += 1
+
+    def _record_failure(self, trial):
+        with self.lock:
+            now = self.clock()
+            if trial:
+                if self.state == self.HALF_OPEN:
+                    self._open(now)
+                return
+            bucket = self._bucket(now)
+            bucket[1] += 1
+            bucket[2] += 1
+            oldest = bucket[0] - len(self.buckets)
+            calls = failures = 0
+            for bucket_id, bucket_calls, bucket_failures in self.buckets:
+                if bucket_id is not None and bucket_id > oldest:
+                    calls += bucket_calls
+                    failures += bucket_failures
+            if self.state == self.CLOSED and calls >= self.minimum_calls and failures >= calls * self.failure_ratio:
+                logger.error("Circuit opened: %s failures out of %s calls.", failures, calls)
+                self._open(now)
+
+    def _release_trial(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trials -= 1
+
+    def advising_function(self, cutpoint, *args, **kwargs):
+        # lock-free check for the common case
+        trial = self.state != self.CLOSED and self._before_call(cutpoint)
+        try:
+            yield
+        except self.exceptions:
+            self._record_failure(trial)
+            raise
+        except Exception:
+            # the dependency did answer
+            self._record_success(trial)
+            raise
+        except BaseException:
+            # cancelled or closed early, can't tell
+            if trial:
+                self._release_trial()
+            raise
+        else:
+            self._record_success(trial)
+
+
+_deadline = ContextVar('aspectlib.contrib.deadline', default=None)
+
+
+def remaining_time():
+    """
+    Returns the number of seconds left till the current deadline (set by a :obj:`timeout` decorated function that is
+    running) or ``None`` if there's no deadline. Useful to pass the budget to calls that take timeouts (eg: sockets).
+    """
+    deadline = _deadline.get()
+    if deadline is not None:
+        return max(0, deadline - time.monotonic())
+
+
+class AbandonedWork(object):
+    """
+    Counts the calls that :obj:`timeout` gave up on while they were running in a thread: ``total`` and ``running``
+    (still running).
+    """
+
+    def __init__(self):
+        self.total = self.running = 0
+        self.lock = threading.Lock()
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the abandoned threads don't exist in the child
+        self.lock = threading.Lock()
+        self.running = 0
+
+    def add(self, future):
+        with self.lock:
+            self.total += 1
+            self.running += 1
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.running -= 1
+
+
+def _run_in_thread(function, args, kwargs, context):
+    future = Future()
+
+    def run():
+        if future.set_running_or_notify_cancel():
+            try:
+                result = context.run(function, *args, **kwargs)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    thread = threading.Thread(target=run, name='aspectlib.contrib.timeout:%s' % function.__name__)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def _get_deadline(seconds, cutpoint):
+    now = time.monotonic()
+    deadline = _deadline.get()
+    if seconds is not None and (deadline is None or now + seconds < deadline):
+        deadline = now + seconds
+    if deadline is not None and deadline <= now:
+        raise TimeoutError('%s: deadline exceeded' % cutpoint.__name__)
+    return deadline
+
+
+def timeout(func=None, seconds=None, threaded=False):
+    """
+    Decorator that limits how long the call can take to ``seconds``. The deadline is propagated (via a context
+    variable) to the decorated functions that are called inside, thus they only get the remaining time (if it's less
+    than their own ``seconds``). Calls made after the deadline passed fail with :obj:`TimeoutError` right away. Use
+    ``seconds=None`` to only use the deadline from the outer calls.
+
+    For coroutine functions :obj:`asyncio.timeout` is used (the coroutine gets cancelled). Regular functions can't
+    be interrupted, so they are only bounded if ``threaded`` is ``True``: the call runs in a new daemon thread that is
+    abandoned (left running) if it doesn't finish in time. Abandoned calls are counted in ``timeout.abandoned`` (an
+    :obj:`AbandonedWork`). Generators aren't bounded.
+
+    Example::
+
+        >>> @timeout(seconds=0.05, threaded=True)
+        ... def slow_func():
+        ...     time.sleep(1)
+        ...
+        >>> slow_func()
+        Traceback (most recent call last):
+        ...
+        TimeoutError: slow_func: deadline exceeded
+    """
+
+    def timeout_decorator(cutpoint):
+        if iscoroutinefunction(cutpoint):
+
+            async def timeout_coroutine_wrapper(*args, **kwargs):
+                deadline = _get_deadline(seconds, cutpoint)
+                if deadline is None:
+                    return await cutpoint(*args, **kwargs)
+                token = _deadline.set(deadline)
+                try:
+                    if hasattr(asyncio, 'timeout'):
+                        try:
+                            async with asyncio.timeout(deadline - time.monotonic()):
+                                return await cutpoint(*args, **kwargs)
+                        except TimeoutError as exc:
+                            if time.monotonic() < deadline:
+                                raise  # not ours
+                            raise TimeoutError('%s: deadline exceeded' % cutpoint.__name__) from exc
+                    else:
+                        try:
+                            return await asyncio.wait_for(cutpoint(*args, **kwargs), deadline - time.monotonic())
+                        except asyncio.TimeoutError as exc:
+                            raise TimeoutError('%s: deadline exceeded' % cutpoint.__name__) from exc
+                finally:
+                    _deadline.reset(token)
+
+            return mimic(timeout_coroutine_wrapper, cutpoint)
+        elif threaded:
+
+            def timeout_thread_wrapper(*args, **kwargs):
+                deadline = _get_deadline(seconds, cutpoint)
+                context = copy_context()
+                context.run(_deadline.set, deadline)
+                future = _run_in_thread(cutpoint, args, kwargs, context)
+                if deadline is not None:
+                    wait((future,), deadline - time.monotonic())
+                    if not future.done():
+                        timeout.abandoned.add(future)
+                        logger.warning("%s(%s, %s) didn't finish in time. Abandoned it.", cutpoint.__name__, args, kwargs)
+                        raise TimeoutError('%s: deadline exceeded' % cutpoint.__name__)
+                return future.result()
+
+            return mimic(timeout_thread_wrapper, cutpoint)
+        else:
+
+            def timeout_wrapper(*args, **kwargs):
+                token = _deadline.set(_get_deadline(seconds, cutpoint))
+                try:
+                    return cutpoint(*args, **kwargs)
+                finally:
+                    _deadline.reset(token)
+
+            return mimic(timeout_wrapper, cutpoint)
+
+    return timeout_decorator if func is None else timeout_decorator(func)
+
+
+timeout.abandoned = AbandonedWork()
+
+
+_KWARGS_MARK = object()
+
+
+def default_key(args, kwargs):
+    """
+    Makes a cache key from the call arguments: a tuple of the arguments if they are hashable, otherwise a tuple of
+    structural representations (via :obj:`aspectlib.utils.repr_ex`) - thus equal lists or dicts make the same key.
+    """
+    key = args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items())) if kwargs else args
+    try:
+        hash(key)
+    except TypeError:
+        key = (_KWARGS_MARK,) + tuple(repr_ex(i) for i in args) + tuple(
+            '%s=%s' % (name, repr_ex(value)) for name, value in sorted(kwargs.items())
+        )
+    return key
+
+
+class Cache(object):
+    """
+    Aspect that memoizes the results, evicting the least recently used ones when there are more than ``maxsize`` and
+    (if ``ttl`` is given) the ones older than ``ttl`` seconds. Exceptions aren't cached. For coroutine functions the
+    results are cached (not the coroutine objects). Generators can't be memoized.
+
+    Args:
+        maxsize (int): Maximum number of cached results (for each instance if ``scope="instance"``). Use ``None`` for
+            no limit. (default: ``128``)
+        ttl (float): Seconds after which a cached result is discarded. (default: ``None`` - never)
+        key (function): Makes the cache key (anything hashable) from ``args`` (a tuple) and ``kwargs`` (a dict).
+            (default: :obj:`default_key`)
+        scope (str): For instance methods: ``"instance"`` - each instance has its own cache (that goes away with the
+            instance), ``"class"`` - the instances of a class share the cache. Other functions (including static and
+            class methods) are cached as usual. (default: ``None`` - the instance is just another argument)
+
+    The statistics (``hits``, ``misses``, ``evictions`` and the ``size``) are available via :obj:`stats`.
+
+    Example::
+
+        >>> cache = Cache(maxsize=2)
+        >>> @cache
+        ... def double(value):
+        ...     print("computing", value)
+        ...     return value * 2
+        ...
+        >>> double(1), double(1), double(2), double(3), double(1)
+        computing 1
+        computing 2
+        computing 3
+        computing 1
+        (2, 2, 4, 6, 2)
+        >>> cache.stats()
+        {'hits': 1, 'misses': 4, 'evictions': 2, 'size': 2}
+    """
+
+    def __init__(self, maxsize=128, ttl=None, key=default_key, scope=None, clock=time.monotonic):
+        if scope not in (None, 'instance', 'class'):
+            raise ValueError("Invalid scope %r. Must be None, 'instance' or 'class'." % (scope,))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.scope = scope
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.store = OrderedDict()
+        self.instance_stores = {}  # id(instance) -> (weakref to instance, store)
+        self.method_types = WeakKeyDictionary()
+        self.hits = self.misses = self.evictions = 0
+        self.aspect = Aspect(bind=True)(self.advising_function)
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the lock might have been held by another thread (the cached results are still good)
+        self.lock = threading.Lock()
+
+    def __call__(self, cutpoint_function):
+        if isgeneratorfunction(cutpoint_function) or isasyncgenfunction(cutpoint_function):
+            raise TypeError("Can't memoize generator function %s." % cutpoint_function)
+        return self.aspect(cutpoint_function)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.store) + sum(len(store) for _, store in list(self.instance_stores.values())),
+            }
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+            self.instance_stores.clear()
+
+    def _forget_instance(self, ident, instance_ref):
+        # called when the instance is collected (maybe while the lock is held, so don't take it)
+        item = self.instance_stores.get(ident)
+        if item is not None and item[0] is instance_ref:
+            del self.instance_stores[ident]
+
+    def _is_method_call(self, cutpoint, args):
+        """
+        Checks if ``args[0]`` is the ``self`` of an instance method call (and not some argument of a static method,
+        class method or function).
+        """
+        if not args:
+            return False
+        klass = type(args[0])
+        methods = self.method_types.setdefault(klass, {})
+        found = methods.get(cutpoint)
+        if found is None:
+            name = cutpoint.__name__
+            for base in klass.__mro__:
+                if name in base.__dict__:
+                    found = isfunction(base.__dict__[name])
+                    break
+            else:
+                found = False
+            methods[cutpoint] = found
+        return found
+
+    def _get_store(self, cutpoint, args, kwargs):
+        store = self.store
+        if self.scope is not None and self._is_method_call(cutpoint, args):
+            if self.scope == 'instance':
+                instance = args[0]
+                ident = id(instance)
+                item = self.instance_stores.get(ident)
+                if item is not None and item[0]() is instance:  # matched by identity, not by equality
+                    store = item[1]
+                    args = args[1:]
+                else:
+                    try:
+                        instance_ref = ref(instance, partial(self._forget_instance, ident))
+                    except TypeError:  # not weakrefable - keep it in the key
+                        store = self.store
+                    else:
+                        store = OrderedDict()
+                        self.instance_stores[ident] = instance_ref, store
+                        args = args[1:]
+            else:
+                args = (type(args[0]),) + args[1:]
+        return store, (cutpoint, self.key(args, kwargs))
+
+    def advising_function(self, cutpoint, *args, **kwargs):
+        lock = self.lock
+        with lock:
+            store, key = self._get_store(cutpoint, args, kwargs)
+            entry = store.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= self.clock():
+                del store[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                store.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            yield Return(entry[1])
+            return
+
+        value = yield
+        with lock:
+            store[key] = None if self.ttl is None else self.clock() + self.ttl, value
+            store.move_to_end(key)
+            if self.maxsize is not None:
+                while len(store) > self.maxsize:
+                    store.popitem(last=False)
+                    self.evictions += 1
+
+
+class _Flight(object):
+    __slots__ = 'event', 'result', 'exception'
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = self.exception = None
+
+
+class SingleFlight(object):
+    """
+    Aspect that coalesces identical calls that run at the same time: the first caller runs the function and the
+    others wait for it and get the same result (or exception). Calls are identical if they are for the same function
+    and make the same ``key`` (see :obj:`default_key`).
+
+    Works with threads and with coroutines (the coroutine runs in a separate task that every caller awaits, so
+    cancelling one caller doesn't cancel the others). Generators can't be coalesced.
+
+    The number of calls that didn't have to run the function is in ``coalesced``.
+
+    Example::
+
+        >>> import asyncio
+        >>> single_flight = SingleFlight()
+        >>> @single_flight
+        ... async def lookup(key):
+        ...     print("looking up", key)
+        ...     await asyncio.sleep(0.01)
+        ...     return key.upper()
+        ...
+        >>> async def main():
+        ...     return await asyncio.gather(lookup('a'), lookup('a'), lookup('b'))
+        ...
+        >>> asyncio.run(main())
+        looking up a
+        looking up b
+        ['A', 'A', 'B']
+        >>> single_flight.coalesced
+        1
+    """
+
+    def __init__(self, key=default_key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.tasks = {}
+        self.coalesced = 0
+        self.aspect = Aspect(bind=True)(self.advising_function)
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the leaders of the flights (threads or tasks) don't exist in the child
+        self.lock = threading.Lock()
+        self.flights.clear()
+        self.tasks.clear()
+
+    def __call__(self, cutpoint_function):
+        if isgeneratorfunction(cutpoint_function) or isasyncgenfunction(cutpoint_function):
+            raise TypeError("Can't coalesce calls to generator function %s." % cutpoint_function)
+        elif iscoroutinefunction(cutpoint_function):
+            return self._make_coroutine_wrapper(cutpoint_function)
+        else:
+            return self.aspect(cutpoint_function)
+
+    def advising_function(self, cutpoint, *args, **kwargs):
+        key = cutpoint, self.key(args, kwargs)
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                leader = True
+                flight = self.flights[key] = _Flight()
+            else:
+                leader = False
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            yield Return(flight.result)
+            return
+
+        try:
+            flight.result = yield
+        except BaseException as exc:
+            flight.exception = exc
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)  # already gone if forked during the call
+            flight.event.set()
+
+    def _make_coroutine_wrapper(self, cutpoint):
+        tasks = self.tasks
+
+        async def single_flight_coroutine_wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            key = loop, cutpoint, self.key(args, kwargs)
+            task = tasks.get(key)
+            if task is None:
+                task = tasks[key] = loop.create_task(cutpoint(*args, **kwargs))
+
+                def forget(_):
+                    if tasks.get(key) is task:
+                        del tasks[key]
+
+                task.add_done_callback(forget)
+            else:
+                self.coalesced += 1
+            return await asyncio.shield(task)
+
+        return mimic(single_flight_coroutine_wrapper, cutpoint)
+
+
+def _single_key(args, kwargs):
+    if len(args) == 1 and not kwargs:
+        return args[0]
+    return default_key(args, kwargs)
+
+
+class _Batch(object):
+    __slots__ = 'keys', 'positions', 'full', 'done', 'results', 'exception'
+
+    def __init__(self):
+        self.keys = []
+        self.positions = {}
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = self.exception = None
+
+    def add(self, key):
+        position = self.positions.get(key)
+        if position is None:
+            position = self.positions[key] = len(self.keys)
+            self.keys.append(key)
+        return position
+
+
+class MicroBatch(object):
+    """
+    Aspect that collects the calls made within ``delay`` seconds (or till there are ``max_size`` different keys) and
+    makes a single call to ``bulk_function`` with the list of keys instead (the decorated function doesn't get called
+    at all). The ``bulk_function`` must return either a sequence with a result for each key (in the same order) or a
+    dict of keys to results. Results that are exception instances get raised (only for the calls with that key).
+
+    The key is the only argument of the call, or a tuple made with :obj:`default_key` if there are more (use ``key``
+    to change that, eg: ``key=lambda args, kwargs: args[1]`` for methods). Keys must be hashable.
+
+    With threads the first caller of a batch waits for the other calls and then calls ``bulk_function``. With
+    coroutines ``bulk_function`` must be a coroutine function too, and it runs in a separate task.
+
+    Example::
+
+        >>> def get_users(ids):
+        ...     print("fetching", ids)
+        ...     return {user_id: 'user%s' % user_id for user_id in ids}
+        ...
+        >>> batch = MicroBatch(get_users, delay=0.05)
+        >>> @batch
+        ... def get_user(user_id):
+        ...     'This is replaced by get_users.'
+        ...
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> with ThreadPoolExecutor(3) as executor:
+        ...     print(list(executor.map(get_user, [1, 2, 1])))
+        fetching [1, 2]
+        ['user1', 'user2', 'user1']
+    """
+
+    def __init__(self, bulk_function, max_size=100, delay=0.005, key=_single_key):
+        self.bulk_function = bulk_function
+        self.max_size = max_size
+        self.delay = delay
+        self.key = key
+        self.lock = threading.Lock()
+        self.batch = None
+        self.loop_batches = WeakKeyDictionary()
+        self.batches = 0
+        self.aspect = Aspect(self.advising_function)
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the callers waiting for the pending batches don't exist in the child
+        self.lock = threading.Lock()
+        self.batch = None
+        self.loop_batches.clear()
+
+    def __call__(self, cutpoint_function):
+        if isgeneratorfunction(cutpoint_function) or isasyncgenfunction(cutpoint_function):
+            raise TypeError("Can't batch calls to generator function %s." % cutpoint_function)
+        elif iscoroutinefunction(cutpoint_function):
+            return self._make_coroutine_wrapper(cutpoint_function)
+        else:
+            return self.aspect(cutpoint_function)
+
+    def _get_result(self, key, results):
+        if isinstance(results, dict):
+            try:
+                result = results[key]
+            except KeyError:
+                result = KeyError(key)
+        else:
+            result = results[key]
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def advising_function(self, *args, **kwargs):
+        key = self.key(args, kwargs)
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = _Batch()
+            position = batch.add(key)
+            if len(batch.keys) >= self.max_size:
+                self.batch = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.delay)
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+                self.batches += 1
+            try:
+                batch.results = self.bulk_function(batch.keys)
+            except BaseException as exc:  # the followers must get it too (eg: KeyboardInterrupt), the leader reraises below
+                batch.exception = exc
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.exception is not None:
+            raise batch.exception
+        yield Return(self._get_result(key if isinstance(batch.results, dict) else position, batch.results))
+
+    def _make_coroutine_wrapper(self, cutpoint):
+        loop_batches = self.loop_batches
+
+        async def dispatch(keys, futures):
+            self.batches += 1
+            try:
+                results = await self.bulk_function(keys)
+            except Exception as exc:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(exc)
+            else:
+                for position, (key, future) in enumerate(zip(keys, futures)):
+                    if not future.done():
+                        try:
+                            future.set_result(self._get_result(key if isinstance(results, dict) else position, results))
+                        except Exception as exc:
+                            future.set_exception(exc)
+            finally:
+                # cancelled (or interrupted) - the callers would wait forever otherwise
+                for future in futures:
+                    if not future.done():
+                        future.cancel()
+
+        def flush(loop, keys, futures):
+            del loop_batches[loop]
+            loop.create_task(dispatch(keys, [futures[key] for key in keys]))
+
+        async def micro_batch_coroutine_wrapper(*args, **kwargs):
+            key = self.key(args, kwargs)
+            loop = asyncio.get_running_loop()
+            batch = loop_batches.get(loop)
+            if batch is None:
+                keys, futures = [], {}
+                timer = loop.call_later(self.delay, flush, loop, keys, futures)
+                batch = loop_batches[loop] = keys, futures, timer
+            keys, futures, timer = batch
+            future = futures.get(key)
+            if future is None:
+                future = futures[key] = loop.create_future()
+                keys.append(key)
+                if len(keys) >= self.max_size:
+                    timer.cancel()
+                    flush(loop, keys, futures)
+            return await asyncio.shield(future)
+
+        return mimic(micro_batch_coroutine_wrapper, cutpoint)
+
+
+class BulkheadFullError(Exception):
+    """
+    Raised by :obj:`Bulkhead` when a call can't be queued or waited more than ``queue_timeout`` in the queue.
+    """
+
+
+class _ThreadWaiter(object):
+    __slots__ = 'granted', 'event'
+
+    def __init__(self):
+        self.granted = False
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+
+def _set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _CoroutineWaiter(object):
+    __slots__ = 'granted', 'loop', 'future'
+
+    def __init__(self):
+        self.granted = False
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(_set_future_result, self.future)
+
+
+def _current_holder():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return threading.get_ident() if task is None else task
+
+
+class Bulkhead(object):
+    """
+    Aspect that limits how many calls can run at the same time (from threads or coroutines). Calls over the limit wait
+    in a queue (in order) of at most ``max_queued`` calls for at most ``queue_timeout`` seconds. A
+    :obj:`BulkheadFullError` is raised if the queue is full or the timeout expires.
+
+    The limit is shared by all the functions decorated with the same instance, eg: weaving it onto a class limits all
+    the calls to the methods of that class. Calls made by the same thread (or asyncio task) that already holds a slot
+    are not counted again, but calls made from other tasks (eg: via :obj:`asyncio.gather`) are. Generators can't be
+    limited.
+
+    Example::
+
+        >>> import aspectlib
+        >>> class Client(object):
+        ...     def get(self, key):
+        ...         return self.fetch(key)
+        ...     def fetch(self, key):
+        ...         print("in flight:", bulkhead.in_flight)
+        ...         return key
+        ...
+        >>> bulkhead = Bulkhead(max_concurrent=1)
+        >>> with aspectlib.weave(Client, bulkhead):
+        ...     Client().get('foo')
+        in flight: 1
+        'foo'
+        >>> bulkhead.in_flight, bulkhead.queued
+        (0, 0)
+    """
+
+    def __init__(self, max_concurrent=10, max_queued=0, queue_timeout=None):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiters = deque()
+        self.rejected = 0
+        self.holders = set()
+        self.aspect = Aspect(self.advising_function)
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # only the forking thread (or task) exists in the child, its slot is released when its call returns
+        self.lock = threading.Lock()
+        self.waiters = deque()
+        self.holders &= {_current_holder()}
+        self.in_flight = len(self.holders)
+
+    @property
+    def queued(self):
+        return len(self.waiters)
+
+    def __call__(self, cutpoint_function):
+        if isgeneratorfunction(cutpoint_function) or isasyncgenfunction(cutpoint_function):
+            raise TypeError("Can't limit generator function %s." % cutpoint_function)
+        elif iscoroutinefunction(cutpoint_function):
+            return self._make_coroutine_wrapper(cutpoint_function)
+        else:
+            return self.aspect(cutpoint_function)
+
+    def _enqueue(self, waiter_class):
+        with self.lock:
+            if self.in_flight < self.max_concurrent and not self.waiters:
+                self.in_flight += 1
+                return
+            if len(self.waiters) >= self.max_queued:
+                self.rejected += 1
+                raise BulkheadFullError('%s calls in flight and %s queued.' % (self.in_flight, len(self.waiters)))
+            waiter = waiter_class()
+            self.waiters.append(waiter)
+            return waiter
+
+    def _dequeue(self, waiter):
+        """
+        Removes a waiter that gave up waiting. Returns ``True`` if it was granted a slot in the meantime.
+        """
+        with self.lock:
+            if waiter.granted:
+                return True
+            self.waiters.remove(waiter)
+            return False
+
+    def _timed_out(self):
+        with self.lock:
+            self.rejected += 1
+        return BulkheadFullError('Waited more than %s seconds in the queue.' % self.queue_timeout)
+
+    def acquire(self):
+        waiter = self._enqueue(_ThreadWaiter)
+        if waiter is not None and not waiter.event.wait(self.queue_timeout) and not self._dequeue(waiter):
+            raise self._timed_out()
+
+    async def acquire_async(self):
+        waiter = self._enqueue(_CoroutineWaiter)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not self._dequeue(waiter):
+                    raise self._timed_out() from None
+            except BaseException:
+                if self._dequeue(waiter):
+                    self.release()
+                raise
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self._grant_waiters()
+
+    def _started(self):
+        """
+        Called after a slot was acquired, the result is passed to :meth:`_finished`.
+        """
+
+    def _finished(self, started, failure):
+        """
+        Called after the slot was released, with the exception type the call raised (or ``None``).
+        """
+
+    def _grant_waiters(self):
+        while self.waiters and self.in_flight < self.max_concurrent:
+            waiter = self.waiters.popleft()
+            waiter.granted = True
+            self.in_flight += 1
+            waiter.wake()
+
+    def advising_function(self, *args, **kwargs):
+        holder = _current_holder()
+        if holder in self.holders:
+            yield
+            return
+        self.acquire()
+        self.holders.add(holder)
+        started = self._started()
+        failure = None
+        try:
+            yield
+        except BaseException as exc:
+            failure = type(exc)
+            raise
+        finally:
+            self.holders.discard(holder)
+            self.release()
+            self._finished(started, failure)
+
+    def _make_coroutine_wrapper(self, cutpoint):
+        async def bulkhead_coroutine_wrapper(*args, **kwargs):
+            holder = asyncio.current_task()
+            if holder in self.holders:
+                return await cutpoint(*args, **kwargs)
+            await self.acquire_async()
+            self.holders.add(holder)
+            started = self._started()
+            failure = None
+            try:
+                return await cutpoint(*args, **kwargs)
+            except BaseException as exc:
+                failure = type(exc)
+                raise
+            finally:
+                self.holders.discard(holder)
+                self.release()
+                self._finished(started, failure)
+
+        return mimic(bulkhead_coroutine_wrapper, cutpoint)
+
+
+class AdaptiveConcurrency(Bulkhead):
+    """
+    A :obj:`Bulkhead` that adjusts its limit (AIMD) from the latency and errors it observes:
+
+    * Each successful call made while at least half of the limit is in use increases the limit by ``1 / limit``
+      (thus by about one for each "round" of calls), up to ``max_limit``.
+    * Each call that raised one of ``exceptions``, or that finished while the smoothed latency is more than
+      ``latency_tolerance`` times the lowest latency seen (the no-load latency), multiplies the limit by
+      ``backoff_ratio``, down to ``min_limit``.
+
+    The lowest latency is measured again after every ``probe_interval`` calls, in case the dependency got slower for
+    good. Like with :obj:`Bulkhead`, calls over the limit are rejected by default (``max_queued=0``).
+
+    For monitoring there's ``limit``, ``latency`` (smoothed, in seconds), ``min_latency``, ``in_flight``,
+    ``queued`` and ``rejected``.
+
+    Example::
+
+        >>> limiter = AdaptiveConcurrency(initial_limit=2)
+        >>> @limiter
+        ... def query():
+        ...     return limiter.in_flight
+        ...
+        >>> query()
+        1
+        >>> limiter.limit
+        2
+    """
+
+    def __init__(
+        self,
+        initial_limit=10,
+        min_limit=1,
+        max_limit=200,
+        backoff_ratio=0.9,
+        latency_tolerance=2.0,
+        smoothing=0.2,
+        probe_interval=1000,
+        exceptions=(Exception,),
+        max_queued=0,
+        queue_timeout=None,
+        clock=time.monotonic,
+    ):
+        super(AdaptiveConcurrency, self).__init__(initial_limit, max_queued, queue_timeout)
+        self.estimate = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.probe_interval = probe_interval
+        self.exceptions = exceptions
+        self.clock = clock
+        self.latency = self.min_latency = None
+        self.samples = 0
+
+    @property
+    def limit(self):
+        return self.max_concurrent
+
+    def _started(self):
+        return self.clock()
+
+    def _finished(self, started, failure):
+        latency = self.clock() - started
+        failed = failure is not None and issubclass(failure, self.exceptions)
+        with self.lock:
+            self.samples += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+            if self.min_latency is None or latency < self.min_latency or not self.samples % self.probe_interval:
+                self.min_latency = latency
+            if failed or self.latency > self.min_latency * self.latency_tolerance:
+                self.estimate = max(self.min_limit, self.estimate * self.backoff_ratio)
+            elif (self.in_flight + 1) * 2 >= self.max_concurrent:
+                self.estimate = min(self.max_limit, self.estimate + 1.0 / self.estimate)
+            self.max_concurrent = max(self.min_limit, int(self.estimate))
+            self._grant_waiters()
+
+
+def _run_offloaded(module, qualname, args, kwargs):
+    target = import_module(module)
+    for name in qualname.split('.'):
+        target = getattr(target, name)
+    return getattr(target, '__offloaded__', target)(*args, **kwargs)
+
+
+def offload(func=None, executor=None, only_in_loop=False):
+    """
+    Decorator that makes a blocking function awaitable by running it in an executor (the loop's default executor if
+    ``executor`` is ``None``), so it doesn't stall the event loop. With a thread executor the context variables are
+    propagated to the call. With a :obj:`~concurrent.futures.ProcessPoolExecutor` the function is imported by name
+    in the worker process (thus it must be defined at module level), and the arguments and result must be picklable.
+
+    If ``only_in_loop`` is ``True`` the call is offloaded only if it's made while an event loop runs in the current
+    thread (the result must be awaited then), otherwise the function is called directly and the result returned.
+
+    Example::
+
+        >>> import asyncio
+        >>> @offload
+        ... def blocking_func():
+        ...     time.sleep(0.01)
+        ...     return 'done'
+        ...
+        >>> asyncio.run(blocking_func())
+        'done'
+    """
+
+    def offload_decorator(cutpoint):
+        if iscoroutinefunction(cutpoint) or isasyncgenfunction(cutpoint) or isgeneratorfunction(cutpoint):
+            raise TypeError("Can't offload %s, it's not a regular function." % cutpoint)
+
+        def submit(loop, args, kwargs):
+            if isinstance(executor, ProcessPoolExecutor):
+                call = partial(_run_offloaded, cutpoint.__module__, cutpoint.__qualname__, args, kwargs)
+            else:
+                call = partial(copy_context().run, cutpoint, *args, **kwargs)
+            return loop.run_in_executor(executor, call)
+
+        if only_in_loop:
+
+            def offload_wrapper(*args, **kwargs):
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    return cutpoint(*args, **kwargs)
+                return submit(loop, args, kwargs)
+
+        else:
+
+            async def offload_wrapper(*args, **kwargs):
+                return await submit(asyncio.get_running_loop(), args, kwargs)
+
+        offload_wrapper.__offloaded__ = cutpoint
+        return mimic(offload_wrapper, cutpoint)
+
+    return offload_decorator if func is None else offload_decorator(func)
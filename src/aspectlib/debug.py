@@ -1,11 +1,28 @@
+import atexit
 import logging
 import os
+import reprlib
+import signal
 import string
 import sys
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from inspect import isgeneratorfunction
+from itertools import count
 from itertools import islice
+from itertools import takewhile
+from json import JSONEncoder
+from types import FunctionType
+from types import MethodType
+from weakref import WeakSet
+from weakref import WeakValueDictionary
+from weakref import ref
 
 from aspectlib import Aspect
 from aspectlib import mimic
+from aspectlib.utils import register_after_fork
 
 try:
     from types import InstanceType
@@ -13,6 +30,7 @@ except ImportError:
     InstanceType = type(None)
 
 logger = logging.getLogger(__name__)
+_BIND_TO_FIRST_ARG = object()
 
 
 def frame_iterator(frame):
@@ -24,42 +42,609 @@ def frame_iterator(frame):
         frame = frame.f_back
 
 
-def format_stack(skip=0, length=6, _sep=os.path.sep):
+def capture_stack(skip=0, length=6, stop=None):
+    """
+    Returns a cheap snapshot (a tuple of ``(code, lineno)`` pairs) of the current callstack. Use :obj:`format_frames`
+    to convert it to a string.
+
+    If `stop` is given (a module/package name or a tuple of names) then the snapshot ends at the first frame that runs
+    code from those modules or packages.
+    """
+    frames = islice(frame_iterator(sys._getframe(1 + skip)), length)
+    if stop:
+        if isinstance(stop, str):
+            stop = stop,
+        packages = tuple(name + '.' for name in stop)
+        frames = takewhile(
+            lambda frame: not (frame.f_globals.get('__name__') in stop or
+                               frame.f_globals.get('__name__', '').startswith(packages)),
+            frames
+        )
+    return tuple((f.f_code, f.f_lineno) for f in frames)
+
+
+FORMAT_FRAMES_CACHE_SIZE = 1024
+_formatted_frames = {}
+
+
+def format_frames(frames, _sep=os.path.sep, _cache=_formatted_frames):
+    """
+    Returns a one-line string from a callstack snapshot made by :obj:`capture_stack`.
+
+    The strings are cached, as the same call sites tend to come up over and over again.
+    """
+    try:
+        return _cache[frames]
+    except KeyError:
+        pass
+    except TypeError:  # not a tuple, can't cache it
+        return format_frames(tuple(frames))
+    text = ' < '.join("%s:%s:%s" % (
+        '/'.join(code.co_filename.split(_sep)[-2:]),
+        lineno,
+        code.co_name
+    ) for code, lineno in frames)
+    if len(_cache) >= FORMAT_FRAMES_CACHE_SIZE:
+        _cache.clear()
+    _cache[frames] = text
+    return text
+
+
+def format_stack(skip=0, length=6, stop=None):
     """
     Returns a one-line string with the current callstack.
     """
-    return ' < '.join("%s:%s:%s" % (
-        '/'.join(f.f_code.co_filename.split(_sep)[-2:]),
-        f.f_lineno,
-        f.f_code.co_name
-    ) for f in islice(frame_iterator(sys._getframe(1 + skip)), length))
+    return format_frames(capture_stack(1 + skip, length, stop))
 
 
 PRINTABLE = string.digits + string.ascii_letters + string.punctuation + ' '
 ASCII_ONLY = ''.join(i if i in PRINTABLE else '.' for i in (chr(c) for c in range(256)))
 
 
+class BoundedRepr(reprlib.Repr):
+    """
+    Like :obj:`reprlib.Repr` (with bigger default limits) but the cost is bounded for big payloads - strings, bytes, ints,
+    sets and dicts are truncated *before* getting converted. Reprs of immutable values that are seen repeatedly are
+    cached.
+
+    Args:
+        cache_size (int):
+            Maximum number of cached reprs. Use ``0`` to disable the cache. (default: ``1024``)
+        limits:
+            Any of the :obj:`reprlib.Repr` limits (``maxlevel``, ``maxstring``, ``maxlist``, ``maxdict`` etc). Also
+            ``maxbytes``.
+
+    Example::
+
+        >>> bounded = BoundedRepr(maxstring=20, maxbytes=17, maxlist=3)
+        >>> bounded.repr(list(range(1000)))
+        '[0, 1, 2, ...]'
+        >>> bounded.repr(b'x' * 10000000)
+        "b'xxxxxxx...xxxxxxx'"
+        >>> bounded.str('x' * 10000000)
+        'xxxxxxxxxxxxxxxxx...'
+    """
+
+    _cacheable_scalars = (str, bytes, int, float, complex, bool, type(None))
+    _str_is_repr = (bytes, bytearray, int, float, complex, bool, type(None), list, tuple, dict, set, frozenset, deque)
+
+    def __init__(self, cache_size=1024, **limits):
+        super(BoundedRepr, self).__init__()
+        self.fillvalue = '...'
+        self.maxlevel = 6
+        self.maxtuple = self.maxlist = self.maxarray = self.maxdict = self.maxset = self.maxfrozenset = self.maxdeque = 100
+        self.maxstring = self.maxbytes = 1000
+        self.maxlong = 400
+        self.maxother = 1000
+        for name, value in limits.items():
+            if not hasattr(self, name):
+                raise TypeError("Unknown limit %r." % name)
+            setattr(self, name, value)
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def _cacheable(self, x):
+        kind = type(x)
+        if kind in (str, bytes):
+            return len(x) <= self.maxstring
+        elif kind is int:
+            return x.bit_length() <= 64
+        elif kind in (tuple, frozenset):
+            return all(type(i) in self._cacheable_scalars for i in islice(x, self.maxtuple))
+        else:
+            return kind in self._cacheable_scalars
+
+    def repr(self, x):
+        if not self.cache_size or not self._cacheable(x):
+            return self.repr1(x, self.maxlevel)
+        key = id(x)
+        try:
+            obj, value = self.cache[key]
+        except KeyError:
+            pass
+        else:
+            if obj is x:
+                return value
+        value = self.repr1(x, self.maxlevel)
+        cache = self.cache
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[key] = x, value  # keeping a reference to x so the id can't get reused
+        return value
+
+    def str(self, x):
+        """
+        Like ``str(x)`` but bounded (just like :obj:`repr`).
+        """
+        kind = type(x)
+        if kind in self._str_is_repr or kind.__str__ is object.__str__:
+            return self.repr(x)
+        text = x if isinstance(x, str) else str(x)
+        if len(text) > self.maxstring:
+            text = text[:max(0, self.maxstring - len(self.fillvalue))] + self.fillvalue
+        return text
+
+    def _repr_bytes(self, x, prefix='', suffix=''):
+        if len(x) <= self.maxbytes:
+            return prefix + repr(bytes(x)) + suffix
+        i = max(0, (self.maxbytes - 3) // 2)
+        j = max(0, self.maxbytes - 3 - i)
+        return '%s%s%s%s%s' % (prefix, repr(bytes(x[:i]))[:-1], self.fillvalue, repr(bytes(x[len(x) - j:]))[2:], suffix)
+
+    def repr_bytes(self, x, level):
+        return self._repr_bytes(x)
+
+    def repr_bytearray(self, x, level):
+        return self._repr_bytes(x, 'bytearray(', ')')
+
+    def repr_int(self, x, level):
+        if x.bit_length() > self.maxlong * 3.33:
+            return '<int with %s bits>' % x.bit_length()
+        return super(BoundedRepr, self).repr_int(x, level)
+
+    def repr_set(self, x, level):
+        if not x:
+            return 'set()'
+        return self._repr_iterable(x, level, '{', '}', self.maxset)
+
+    def repr_frozenset(self, x, level):
+        if not x:
+            return 'frozenset()'
+        return self._repr_iterable(x, level, 'frozenset({', '})', self.maxfrozenset)
+
+    def repr_dict(self, x, level):
+        if not x:
+            return '{}'
+        if level <= 0:
+            return '{%s}' % self.fillvalue
+        repr1 = self.repr1
+        pieces = ['%s: %s' % (repr1(key, level - 1), repr1(value, level - 1)) for key, value in islice(x.items(), self.maxdict)]
+        if len(x) > self.maxdict:
+            pieces.append(self.fillvalue)
+        return '{%s}' % ', '.join(pieces)
+
+
+bounded = BoundedRepr()
+bounded_repr = bounded.repr
+
+
 def strip_non_ascii(val):
     """
-    Convert to string (using `str`) and replace non-ascii characters with a dot (``.``).
+    Convert to string (using a bounded `str`) and replace non-ascii characters with a dot (``.``).
+    """
+    return bounded.str(val).translate(ASCII_ONLY)
+
+
+_json_encode = JSONEncoder(ensure_ascii=False, check_circular=False, separators=(',', ':'), default=repr).encode
+
+
+def _current_task_id():
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is not None:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            return None
+        return task and id(task)
+
+
+def format_duration(ns):
+    """
+    Returns a short human readable string for a duration given in nanoseconds.
+
+    Example::
+
+        >>> format_duration(512), format_duration(1500), format_duration(25000000), format_duration(3 * 10**9)
+        ('512ns', '1.5us', '25.0ms', '3.000s')
+    """
+    if ns < 1000:
+        return '%dns' % ns
+    elif ns < 1000000:
+        return '%.1fus' % (ns / 1000)
+    elif ns < 1000000000:
+        return '%.1fms' % (ns / 1000000)
+    else:
+        return '%.3fs' % (ns / 1000000000)
+
+
+class LatencyHistogram(object):
+    """
+    A histogram of durations (in nanoseconds) with log-linear buckets, similar to a HDR histogram: each power of 2 is
+    split in ``2 ** (precision - 1)`` buckets, thus the memory is bounded and the relative error is at most
+    ``2 ** (1 - precision)`` (about 3% with the default precision).
+
+    Args:
+        name (str): A label for the output of :obj:`format`.
+        precision (int): Number of significant bits kept from each value. (default: ``6``)
+
+    Example::
+
+        >>> histogram = LatencyHistogram('foo')
+        >>> for ns in range(1000, 101000, 1000):
+        ...     histogram.record(ns)
+        >>> histogram.count, histogram.min, histogram.max
+        (100, 1000, 100000)
+        >>> histogram.percentile(50), histogram.percentile(99), histogram.percentile(100)
+        (50175, 100000, 100000)
+        >>> print(histogram.format())
+        foo: count=100 mean=50.5us min=1.0us p50=50.2us p90=90.1us p99=100.0us p99.9=100.0us max=100.0us
+    """
+    __slots__ = 'name', 'precision', 'counts', 'count', 'total', 'min', 'max', 'lock', '__weakref__'
+
+    def __init__(self, name='', precision=6):
+        self.name = name
+        self.precision = precision
+        self.lock = threading.Lock()
+        self.reset()
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the lock might have been held by another thread, and the child should only report its own calls
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.count = self.total = self.max = 0
+            self.min = None
+
+    def record(self, ns):
+        shift = ns.bit_length() - self.precision
+        bucket = ns >> shift << shift if shift > 0 else ns
+        with self.lock:
+            counts = self.counts
+            counts[bucket] = counts.get(bucket, 0) + 1
+            self.count += 1
+            self.total += ns
+            if self.min is None or ns < self.min:
+                self.min = ns
+            if ns > self.max:
+                self.max = ns
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, percent):
+        """
+        Returns the highest value (within the precision of the buckets) under which `percent` of the recorded values
+        fall.
+        """
+        with self.lock:
+            count = self.count
+            buckets = sorted(self.counts.items())
+        if not count:
+            return 0
+        threshold = count * percent / 100
+        seen = 0
+        for bucket, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= threshold:
+                break
+        shift = bucket.bit_length() - self.precision
+        return min(bucket + (1 << shift) - 1 if shift > 0 else bucket, self.max)
+
+    def snapshot(self):
+        """
+        Returns a dict with the ``count``, ``mean``, ``min``, ``max`` and a few percentiles (``p50``, ``p90``, ``p99``
+        and ``p99.9``).
+        """
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min or 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p99.9': self.percentile(99.9),
+            'max': self.max,
+        }
+
+    def format(self):
+        """
+        Returns a one-line summary.
+        """
+        return '%s: count=%s %s' % (self.name, self.count, ' '.join(
+            '%s=%s' % (key, format_duration(value))
+            for key, value in self.snapshot().items() if key != 'count'
+        ))
+
+
+_trace_ids = count(1)
+_current_trace_node = ContextVar('aspectlib.debug.trace', default=None)
+_histograms_lock = threading.Lock()
+
+
+def _after_fork_histograms_lock():
+    global _histograms_lock
+    _histograms_lock = threading.Lock()
+
+
+register_after_fork(_after_fork_histograms_lock)
+
+
+class _TraceNode(object):
+    """
+    A call in the tree built by ``log(trace=True)``. The current node is kept in a context variable, thus each thread
+    and each asyncio task has its own branch.
+    """
+    __slots__ = 'id', 'parent', 'depth', 'children_duration'
+
+    def __init__(self, parent):
+        self.id = next(_trace_ids)
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.children_duration = 0
+
+
+_flusher_lock = threading.Lock()
+_flusher_wakeup = threading.Event()
+_flusher_thread = None
+_batched_writers = WeakSet()
+
+
+def _after_fork_flusher():
+    # the thread doesn't exist in the child
+    global _flusher_lock, _flusher_wakeup, _flusher_thread
+    _flusher_lock = threading.Lock()
+    _flusher_wakeup = threading.Event()
+    _flusher_thread = None
+
+
+register_after_fork(_after_fork_flusher)
+
+
+def _wake_flusher():
+    global _flusher_thread
+    if _flusher_thread is None:
+        with _flusher_lock:
+            if _flusher_thread is None:
+                _flusher_thread = threading.Thread(target=_run_flusher, name='aspectlib.debug.flusher')
+                _flusher_thread.daemon = True
+                _flusher_thread.start()
+    _flusher_wakeup.set()
+
+
+def _run_flusher():
+    """
+    Writes the batches that are too old, for all the :obj:`_BatchedWriter` objects (a single thread sleeps till the
+    nearest deadline).
+    """
+    timeout = None
+    while True:
+        _flusher_wakeup.wait(timeout)
+        _flusher_wakeup.clear()
+        now = time.monotonic()
+        # no references to the writers are left while waiting (they can go away)
+        deadlines = [deadline for deadline in [writer.flush_expired(now) for writer in list(_batched_writers)] if deadline is not None]
+        timeout = min(deadlines) - now if deadlines else None
+
+
+class _BatchedWriter(object):
+    """
+    Collects the output for ``log(print_batch_size=...)`` and writes it in big chunks: when there's `max_size` of
+    pending text, when the oldest pending text is `max_delay` seconds old (checked by a single thread shared by all
+    the writers) or when :obj:`flush` is called (at exit too).
     """
-    return str(val).translate(ASCII_ONLY)
+
+    def __init__(self, file, max_size, max_delay=1.0):
+        self.file = file
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.size = 0
+        self.deadline = None
+        self.lock = threading.Lock()
+        _batched_writers.add(self)
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the pending output belongs to the parent (it writes it)
+        self.pending = []
+        self.size = 0
+        self.deadline = None
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.pending.append(text)
+            self.size += len(text)
+            if self.size >= self.max_size:
+                self._write()
+            elif self.deadline is None and self.max_delay is not None:
+                self.deadline = time.monotonic() + self.max_delay
+                _wake_flusher()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self._write()
+
+    def flush_expired(self, now):
+        """
+        Writes the pending output if it's too old. Returns the deadline of the pending output otherwise.
+        """
+        with self.lock:
+            if self.deadline is not None and self.deadline <= now:
+                self._write()
+            else:
+                return self.deadline
+
+    def _write(self):
+        data = ''.join(self.pending)
+        self.pending = []
+        self.size = 0
+        self.deadline = None
+        try:
+            self.file.write(data)
+        except Exception as exc:
+            logger.critical('Failed to log a message: %s', exc, exc_info=True)
+
+
+_background_sinks = WeakSet()
+
+
+class _BackgroundSink(object):
+    """
+    Queue drained by a daemon thread that does the formatting and the writing for ``log(background=True)``.
+
+    The producer side doesn't take any locks (``deque.append`` is atomic) unless the queue is full and the overflow
+    policy is ``"block"``.
+    """
+
+    def __init__(self, dump, maxsize=10000, overflow='block', sample_rate=10):
+        if overflow not in ('block', 'drop', 'sample'):
+            raise ValueError("Invalid overflow policy %r. Must be 'block', 'drop' or 'sample'." % (overflow,))
+        self.dump = dump
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.overflows = 0
+        self.dropped = 0
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.waiting = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.poll = None
+        _background_sinks.add(self)
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the thread doesn't exist in the child and the queued events belong to the parent
+        self.queue.clear()
+        self.wakeup = threading.Event()
+        self.waiting = False
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, render, *args):
+        queue = self.queue
+        if len(queue) >= self.maxsize:
+            self.overflows += 1
+            if self.overflow == 'drop' or self.overflow == 'sample' and self.overflows % self.sample_rate:
+                self.dropped += 1
+                return
+            elif self.overflow == 'sample':
+                try:
+                    queue.popleft()
+                except IndexError:
+                    pass
+                else:
+                    self.dropped += 1
+            else:
+                while len(queue) >= self.maxsize and self.thread is not None and self.thread.is_alive():
+                    self.wakeup.set()
+                    time.sleep(0.001)
+        queue.append((render, args))
+        if self.thread is None:
+            self._start()
+        elif self.waiting:
+            self.wakeup.set()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, args=(ref(self),), name='aspectlib.debug.log')
+                self.thread.daemon = True
+                self.thread.start()
+
+    @staticmethod
+    def _run(sink_ref):
+        # the sink is only held while working, so the thread ends (within a second) after the sink is garbage collected
+        while True:
+            sink = sink_ref()
+            if sink is None:
+                return
+            sink.waiting = False
+            if sink.poll is not None:
+                sink.poll()
+            sink.drain()
+            sink.waiting = True
+            if not sink.queue:
+                wakeup = sink.wakeup
+                del sink
+                wakeup.wait(1)
+                wakeup.clear()
+
+    def drain(self):
+        queue = self.queue
+        with self.lock:
+            while queue:
+                try:
+                    render, args = queue.popleft()
+                except IndexError:
+                    break
+                try:
+                    buf = render(*args)
+                except Exception as exc:
+                    logger.critical('Failed to format a message: %s', exc, exc_info=True)
+                else:
+                    if buf is not None:
+                        self.dump(buf)
+
+    flush = drain
+
+
+def _flush_at_exit():
+    # the background queues first - they might write to the batched writers
+    for sink in list(_background_sinks):
+        sink.flush()
+    for writer in list(_batched_writers):
+        writer.flush()
+
+
+atexit.register(_flush_at_exit)
 
 
 def log(func=None,
         stacktrace=10,
         stacktrace_align=60,
+        stacktrace_stop=None,
         attributes=(),
         module=True,
         call=True,
         call_args=True,
-        call_args_repr=repr,
+        call_args_repr=bounded_repr,
         result=True,
         exception=True,
         exception_repr=repr,
         result_repr=strip_non_ascii,
         use_logging='CRITICAL',
-        print_to=None):
+        print_to=None,
+        outermost=False,
+        background=False,
+        queue_size=10000,
+        overflow='block',
+        json_lines=False,
+        timing=False,
+        trace=False,
+        print_batch_size=0,
+        print_batch_delay=1.0,
+        flight_recorder=0,
+        flight_recorder_scope='global',
+        flight_recorder_signal=None):
     """
     Decorates `func` to have logging.
 
@@ -70,6 +655,10 @@ def log(func=None,
             Number of frames to show.
         stacktrace_align (int):
             Column to align the framelist to.
+        stacktrace_stop (string or tuple):
+            Module or package names (eg: ``"asyncio"`` or ``("pytest", "_pytest", "pluggy")``) where the stack
+            shouldn't be followed anymore. The frames from these modules and all the frames above them are left out.
+            (default: ``None`` - show all the frames, up to ``stacktrace``)
         attributes (list):
             List of instance attributes to show, in case the function is a instance method.
         module (bool):
@@ -79,8 +668,9 @@ def log(func=None,
             enabled) (default: ``True``)
         call_args (bool):
             If ``True``, then show call arguments. (default: ``True``)
-        call_args_repr (bool):
-            Function to convert one argument to a string. (default: ``repr``)
+        call_args_repr (function):
+            Function to convert one argument to a string. (default: ``bounded_repr`` - like ``repr`` but the output
+            length, nesting and cost are bounded. See :obj:`BoundedRepr`.)
         result (bool):
             If ``True``, then show result. (default: ``True``)
         exception (bool):
@@ -88,13 +678,70 @@ def log(func=None,
         exception_repr (function):
             Function to convert an exception to a string. (default: ``repr``)
         result_repr (function):
-            Function to convert the result object to a string. (default: ``strip_non_ascii`` - like ``str`` but nonascii
-            characters are replaced with dots.)
+            Function to convert the result object to a string. (default: ``strip_non_ascii`` - like ``str`` (bounded)
+            but nonascii characters are replaced with dots.)
         use_logging (string):
             Emit log messages with the given loglevel. (default: ``"CRITICAL"``)
         print_to (fileobject):
             File object to write to, in case you don't want to use logging module. (default: ``None`` - printing is
             disabled)
+        outermost (bool):
+            If ``True``, then only log the outermost call - recursive calls (or calls to other functions decorated by the
+            same ``log``) made while the outermost call is running aren't logged. (default: ``False``)
+        background (bool):
+            If ``True``, then the calling thread only queues references to the arguments, results and a snapshot of the
+            callstack. A background thread does the formatting and the writing (the queue is flushed at exit, or
+            via the ``flush()`` method of the returned decorator). Each decorator made with ``background=True`` has its
+            own thread: it's started on the first call and ends after the decorator (and all the functions decorated
+            with it) is garbage collected. Note that the arguments are formatted later, so if they are mutated after
+            the call the output will show the new state. (default: ``False``)
+        queue_size (int):
+            Maximum number of queued events in ``background`` mode. (default: ``10000``)
+        overflow (string):
+            What to do when the queue is full in ``background`` mode: ``"block"`` the caller till there's space,
+            ``"drop"`` the new events or ``"sample"`` - drop most new events but let every 10th in (at the expense of
+            the oldest queued event). (default: ``"block"``)
+        timing (bool):
+            If ``True``, then measure the calls (with :obj:`time.perf_counter_ns` - for generators and coroutines
+            it's the time till they finish) and show the durations on the result and exception lines. The durations
+            are also collected in a :obj:`LatencyHistogram` for each decorated function (even if nothing is logged)
+            which can be retrieved via the ``histograms()`` method of the returned decorator (a dict of names to
+            histograms) or printed via the ``dump_histograms()`` method. (default: ``False``)
+        trace (bool):
+            If ``True``, then show the calls as a tree: calls made while another traced call is running (in the same
+            thread or asyncio task - including tasks started from it) are indented under it, and the result and
+            exception lines show the inclusive (``total``) and exclusive (``self``) times. In ``json_lines`` mode the
+            events get ``id``, ``parent`` and ``depth`` fields instead, and ``exclusive_ns``. Note that children running
+            concurrently (eg: via ``asyncio.gather``) make the exclusive time smaller than it really is. Generators don't
+            become parents, as the code consuming them runs between the items. (default: ``False``)
+        print_batch_size (int):
+            If non-zero, then the output for ``print_to`` is collected and written in chunks of (at least) that many
+            characters. Pending output is written anyway after ``print_batch_delay`` seconds, after an exception is
+            logged, at exit or via the ``flush()`` method of the returned decorator. (default: ``0`` - write each line
+            as soon as it's formatted)
+        print_batch_delay (float):
+            Maximum number of seconds output is held back in ``print_batch_size`` mode. Use ``None`` for no time limit.
+            (default: ``1.0``)
+        json_lines (bool):
+            If ``True``, then output one JSON object per event (``"call"``, ``"return"`` or ``"raise"``) instead of the
+            free-form lines. The objects have the qualified ``name``, ``thread`` and ``task`` ids, ``args``, ``kwargs``
+            and ``stack`` (for calls), ``result`` or ``exception`` and ``duration_ns`` (for returns and raises). The
+            values are converted to strings with the ``*_repr`` functions. (default: ``False``)
+        flight_recorder (int):
+            If non-zero, then don't output anything as it happens. Instead, keep that many of the most recent events in
+            memory (just references to the arguments, results and a snapshot of the callstack) and only format and
+            output them when an exception passes through a decorated function, when ``flight_recorder_signal`` is
+            received or when the ``dump_flight_recorder()`` method of the returned decorator is called. Note that, like
+            in ``background`` mode, the arguments are formatted later. For the cheapest recording also use
+            ``stacktrace=False``. (default: ``0`` - disabled)
+        flight_recorder_scope (string):
+            Keep one buffer for all the threads (``"global"``) or one buffer for each thread (``"thread"``). With
+            ``"thread"`` an exception only dumps the buffer of the thread where it happened. (default: ``"global"``)
+        flight_recorder_signal (int):
+            Signal number (eg: ``signal.SIGUSR1``) that dumps all the buffers. The signal handler only makes a request
+            (it doesn't take any locks) - the dump is done by the next call to a decorated function or, in
+            ``background`` mode, by the background thread (within a second). The previous signal handler is still
+            called. (default: ``None``)
 
     Returns:
         A decorator or a wrapper.
@@ -150,36 +797,219 @@ def log(func=None,
     ).get(use_logging, logging.CRITICAL)
     _missing = object()
 
+    def enabled():
+        return print_to or use_logging and logger.isEnabledFor(loglevel)
+
+    if print_to and print_batch_size:
+        writer = _BatchedWriter(print_to, print_batch_size, print_batch_delay)
+
+        def flush_writer():
+            writer.flush()  # returns None - nothing to dump
+    else:
+        writer = flush_writer = None
+
     def dump(buf):
+        if buf is None:
+            return
         try:
-            if use_logging:
+            if use_logging and logger.isEnabledFor(loglevel):
                 logger._log(loglevel, buf, ())
             if print_to:
                 buf += '\n'
-                print_to.write(buf)
+                if writer:
+                    writer.write(buf)
+                else:
+                    print_to.write(buf)
         except Exception as exc:
             logger.critical('Failed to log a message: %s', exc, exc_info=True)
 
+    if background:
+        sink = _BackgroundSink(dump, queue_size, overflow)
+        emit = sink.put
+    else:
+        sink = None
+
+        def emit(render, *args):
+            dump(render(*args))
+
+    if flight_recorder:
+        if flight_recorder_scope == 'global':
+            recorder_buffer = deque(maxlen=flight_recorder)
+            recorder_buffers = {None: recorder_buffer}
+
+            def current_recorder_buffer():
+                return recorder_buffer
+
+            def record_event(render, *args):
+                recorder_buffer.append((render, args))
+        elif flight_recorder_scope == 'thread':
+            recorder_local = threading.local()
+            recorder_buffers = WeakValueDictionary()  # the buffers go away with their threads
+
+            def current_recorder_buffer():
+                try:
+                    return recorder_local.buffer
+                except AttributeError:
+                    buffer = recorder_local.buffer = deque(maxlen=flight_recorder)
+                    recorder_buffers[threading.get_ident()] = buffer
+                    return buffer
+
+            def record_event(render, *args):
+                current_recorder_buffer().append((render, args))
+        else:
+            raise ValueError("Invalid flight_recorder_scope %r. Must be 'global' or 'thread'." % (flight_recorder_scope,))
+
+        def replay(buffer, emit_event=emit):
+            while True:
+                try:
+                    render, args = buffer.popleft()
+                except IndexError:
+                    break
+                emit_event(render, *args)
+
+        def dump_recorded(emit_event=emit):
+            for buffer in list(recorder_buffers.values()):
+                replay(buffer, emit_event)
+
+        if flight_recorder_signal is not None:
+            previous_handler = signal.getsignal(flight_recorder_signal)
+            dump_requests = deque(maxlen=1)
+
+            def handle_signal(signum, frame):
+                # just a request (deque.append doesn't take locks) - dumping right here could deadlock on the locks
+                # held by the interrupted code (eg: while it was writing the output)
+                dump_requests.append(signum)
+                if callable(previous_handler):
+                    previous_handler(signum, frame)
+
+            def take_dump_request():
+                try:
+                    dump_requests.popleft()
+                except IndexError:
+                    return False
+                else:
+                    return True
+
+            keep_event = record_event
+
+            def record_event(render, *args):
+                if dump_requests and take_dump_request():
+                    dump_recorded()
+                keep_event(render, *args)
+
+            if sink:
+                def poll_dump_requests():
+                    if take_dump_request():
+                        # already on the background thread - no point in waiting for space in the queue
+                        dump_recorded(lambda render, *args: sink.queue.append((render, args)))
+
+                sink.poll = poll_dump_requests
+                sink._start()
+
+            signal.signal(flight_recorder_signal, handle_signal)
+    else:
+        record_event = emit
+
+        def dump_recorded():
+            pass
+
+    timed = json_lines or timing or trace
+    histograms = {}
+
+    def get_histogram(cutpoint_function):
+        function = getattr(cutpoint_function, '__func__', cutpoint_function)
+        try:
+            return histograms[function]
+        except KeyError:
+            with _histograms_lock:
+                if function not in histograms:
+                    histograms[function] = LatencyHistogram('%s.%s' % (
+                        getattr(function, '__module__', None) or '?',
+                        getattr(function, '__qualname__', None) or getattr(function, '__name__', '?'),
+                    ))
+                return histograms[function]
+
+    def get_histograms():
+        return {histogram.name: histogram for histogram in list(histograms.values())}
+
+    def dump_all_histograms():
+        for _, histogram in sorted(get_histograms().items()):
+            dump(histogram.format())
+
+    def finish(logged, record, token):
+        record.duration = time.perf_counter_ns() - record.start
+        if timing:
+            get_histogram(logged.cutpoint_function).record(record.duration)
+        if trace:
+            parent = record.node.parent
+            if parent is not None:
+                parent.children_duration += record.duration
+            if token is not None:
+                _current_trace_node.reset(token)
+
+    class _CallRecord(object):
+        __slots__ = (
+            'logged', 'binding', 'args', 'kwargs', 'frames', 'signature', 'thread', 'task', 'start', 'duration', 'node'
+        )
+
+        def __init__(self, logged, binding, args, kwargs, frames):
+            self.logged = logged
+            self.binding = binding
+            self.args = args
+            self.kwargs = kwargs
+            self.frames = frames
+            self.signature = None
+            if json_lines:
+                self.thread = threading.get_ident()
+                self.task = _current_task_id()
+            if timed:
+                self.start = time.perf_counter_ns()
+
+        @property
+        def sig(self):
+            if self.signature is None:
+                self.signature = self.logged.signature(self.binding)
+            return self.signature
+
     class __logged__(Aspect):
-        __slots__ = 'cutpoint_function', 'final_function', 'binding', '__name__', '__weakref__'
+        __slots__ = 'cutpoint_function', 'final_function', 'binding', 'method', 'is_generator', '__name__', '__weakref__'
 
         bind = False
+        _outermost = ContextVar('aspectlib.debug.outermost', default=False) if outermost else None
+
+        @staticmethod
+        def flush():
+            if sink:
+                sink.flush()
+            if writer:
+                writer.flush()
+
+        dump_flight_recorder = staticmethod(dump_recorded)
+        histograms = staticmethod(get_histograms)
+        dump_histograms = staticmethod(dump_all_histograms)
 
         def __init__(self, cutpoint_function, binding=None):
             mimic(self, cutpoint_function)
             self.cutpoint_function = cutpoint_function
             self.final_function = super(__logged__, self).__call__(cutpoint_function)
             self.binding = binding
+            self.method = None
+            self.is_generator = isgeneratorfunction(cutpoint_function)
 
         def __get__(self, instance, owner):
+            if instance is not None and isinstance(self.cutpoint_function, FunctionType):
+                # build the wrapper only once - it takes the instance from the arguments
+                method = self.method
+                if method is None:
+                    method = self.method = __logged__(self.cutpoint_function, _BIND_TO_FIRST_ARG)
+                return MethodType(method, instance)
             return __logged__(self.cutpoint_function.__get__(instance, owner), instance)
 
         def __call__(self, *args, **kwargs):
             return self.final_function(*args, **kwargs)
 
-        def advising_function(self, *args, **kwargs):
+        def signature(self, instance):
             name = self.cutpoint_function.__name__
-            instance = self.binding
             if instance is not None:
                 if isinstance(instance, InstanceType):
                     instance_type = instance.__class__
@@ -197,36 +1027,164 @@ def log(func=None,
                         info.append(' %s=%s' % (
                             key, call_args_repr(val() if callarg else val)
                         ))
-                sig = buf = '{%s%s%s}.%s' % (
+                return '{%s%s%s}.%s' % (
                     instance_type.__module__ + '.' if module else '',
                     instance_type.__name__,
                     ''.join(info),
                     name
                 )
             else:
-                sig = buf = name
+                return name
+
+        @staticmethod
+        def format_times(record):
+            if trace:
+                return ' (%s total, %s self)' % (
+                    format_duration(record.duration), format_duration(record.duration - record.node.children_duration)
+                )
+            elif timing:
+                return ' (%s)' % format_duration(record.duration)
+            else:
+                return ''
+
+        @staticmethod
+        def format_call(record):
+            buf = '  ' * record.node.depth + record.sig if trace else record.sig
+            args = record.args
+            kwargs = record.kwargs
             if call_args:
                 buf += '(%s%s)' % (
-                    ', '.join(repr(i) for i in (args if call_args is True else args[:call_args])),
-                    ((', ' if args else '') + ', '.join('%s=%r' % i for i in kwargs.items()))
+                    ', '.join(call_args_repr(i) for i in (args if call_args is True else args[:call_args])),
+                    ((', ' if args else '') + ', '.join('%s=%s' % (key, call_args_repr(value)) for key, value in kwargs.items()))
                     if kwargs and call_args is True
                     else '',
                 )
             if stacktrace:
-                buf = ("%%-%ds  <<< %%s" % stacktrace_align) % (buf, format_stack(skip=1, length=stacktrace))
+                buf = ("%%-%ds  <<< %%s" % stacktrace_align) % (buf, format_frames(record.frames))
+            return buf
+
+        @classmethod
+        def format_exception(cls, record, exc):
+            return '%s%s ~ raised %s%s' % (
+                '  ' * record.node.depth if trace else '', record.sig, exception_repr(exc), cls.format_times(record)
+            )
+
+        @classmethod
+        def format_result(cls, record, res):
+            return '%s%s => %s%s' % (
+                '  ' * record.node.depth if trace else '', record.sig, result_repr(res), cls.format_times(record)
+            )
+
+        def qualname(self, instance):
+            name = self.cutpoint_function.__name__
+            if instance is not None:
+                instance_type = instance.__class__ if isinstance(instance, InstanceType) else type(instance)
+                return '%s.%s.%s' % (instance_type.__module__, instance_type.__qualname__, name)
+            else:
+                return '%s.%s' % (
+                    getattr(self.cutpoint_function, '__module__', None) or '?',
+                    getattr(self.cutpoint_function, '__qualname__', name),
+                )
+
+        @staticmethod
+        def json_call(record):
+            event = {'event': 'call', 'name': record.logged.qualname(record.binding), 'thread': record.thread, 'task': record.task}
+            if trace:
+                node = record.node
+                event.update(id=node.id, parent=node.parent and node.parent.id, depth=node.depth)
+            if call_args:
+                args = record.args
+                event['args'] = [call_args_repr(i) for i in (args if call_args is True else args[:call_args])]
+                if call_args is True:
+                    event['kwargs'] = {key: call_args_repr(value) for key, value in record.kwargs.items()}
+            if stacktrace:
+                event['stack'] = [(code.co_filename, lineno, code.co_name) for code, lineno in record.frames]
+            return _json_encode(event)
+
+        @staticmethod
+        def json_exception(record, exc):
+            event = {
+                'event': 'raise', 'name': record.logged.qualname(record.binding), 'thread': record.thread, 'task': record.task,
+                'exception': exception_repr(exc), 'duration_ns': record.duration,
+            }
+            if trace:
+                event.update(id=record.node.id, exclusive_ns=record.duration - record.node.children_duration)
+            return _json_encode(event)
+
+        @staticmethod
+        def json_result(record, res):
+            event = {
+                'event': 'return', 'name': record.logged.qualname(record.binding), 'thread': record.thread, 'task': record.task,
+                'result': result_repr(res), 'duration_ns': record.duration,
+            }
+            if trace:
+                event.update(id=record.node.id, exclusive_ns=record.duration - record.node.children_duration)
+            return _json_encode(event)
+
+        if json_lines:
+            render_call, render_exception, render_result = json_call, json_exception, json_result
+        else:
+            render_call, render_exception, render_result = format_call, format_exception, format_result
+
+        def advising_function(self, *args, **kwargs):
+            if not enabled():
+                # nothing would be output - don't waste time on formatting
+                if timing:
+                    histogram = get_histogram(self.cutpoint_function)
+                    start = time.perf_counter_ns()
+                    try:
+                        yield
+                    except BaseException:
+                        histogram.record(time.perf_counter_ns() - start)
+                        raise
+                    histogram.record(time.perf_counter_ns() - start)
+                else:
+                    yield
+                return
+            binding = self.binding
+            if binding is _BIND_TO_FIRST_ARG:
+                binding = args[0]
+                args = args[1:]
+            record = _CallRecord(
+                self, binding, args, kwargs, capture_stack(1, stacktrace, stacktrace_stop) if stacktrace and call else None
+            )
+            if not background and not flight_recorder and not json_lines and (call or result):
+                # attributes are shown as they were before the call
+                record.signature = self.signature(binding)
+            token = None
+            if trace:
+                record.node = _TraceNode(_current_trace_node.get())
+                if not self.is_generator:
+                    token = _current_trace_node.set(record.node)
             if call:
-                dump(buf)
+                record_event(self.render_call, record)
             try:
                 res = yield
             except Exception as exc:
+                if timed:
+                    finish(self, record, token)
                 if exception:
                     if not call:
-                        dump(buf)
-                    dump('%s ~ raised %s' % (sig, exception_repr(exc)))
+                        if stacktrace:
+                            record.frames = capture_stack(1, stacktrace, stacktrace_stop)
+                        record_event(self.render_call, record)
+                    record_event(self.render_exception, record, exc)
+                if flight_recorder:
+                    replay(current_recorder_buffer())
+                if writer:
+                    # queued after the exception details (if in background mode)
+                    emit(flush_writer)
+                raise
+            except BaseException:
+                # cancelled, interrupted or closed - not logged but the trace node must not stay current
+                if timed:
+                    finish(self, record, token)
                 raise
 
+            if timed:
+                finish(self, record, token)
             if result:
-                dump('%s => %s' % (sig, result_repr(res)))
+                record_event(self.render_result, record, res)
 
     if func:
         return __logged__(func)
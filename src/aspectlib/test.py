@@ -20,6 +20,7 @@ from .utils import camelcase_to_underscores
 from .utils import container
 from .utils import logf
 from .utils import qualname
+from .utils import register_after_fork
 from .utils import repr_ex
 
 try:
@@ -174,7 +175,9 @@ class _RecordingFunctionWrapper(object):
     See :obj:`aspectlib.test.record` for arguments.
     """
 
-    def __init__(self, wrapped, iscalled=True, calls=None, callback=None, extended=False, results=False, recurse_lock=None, binding=None):
+    def __init__(
+        self, wrapped, iscalled=True, calls=None, callback=None, extended=False, results=False, recurse_lock_factory=None, binding=None
+    ):
         assert not results or iscalled, "`iscalled` must be True if `results` is True"
         mimic(self, wrapped)
         self.__wrapped = wrapped
@@ -184,11 +187,19 @@ class _RecordingFunctionWrapper(object):
         self.__callback = callback
         self.__extended = extended
         self.__results = results
-        self.__recurse_lock = recurse_lock
+        self.__recurse_lock_factory = recurse_lock_factory
+        self.__recurse_lock = recurse_lock_factory and recurse_lock_factory()
         self.calls = [] if not callback and calls is None else calls
+        if self.__recurse_lock:
+            register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # the lock might have been held by another thread of the parent process at fork time
+        self.__recurse_lock = self.__recurse_lock_factory()
 
     def __call__(self, *args, **kwargs):
-        record = not self.__recurse_lock or self.__recurse_lock.acquire(False)
+        recurse_lock = self.__recurse_lock
+        record = not recurse_lock or recurse_lock.acquire(False)
         try:
             if self.__results:
                 try:
@@ -207,8 +218,8 @@ class _RecordingFunctionWrapper(object):
                 if self.__iscalled:
                     return self.__wrapped(*args, **kwargs)
         finally:
-            if record and self.__recurse_lock:
-                self.__recurse_lock.release()
+            if record and recurse_lock:
+                recurse_lock.release()
 
     def __record(self, args, kwargs, *response):
         if self.__callback is not None:
@@ -290,7 +301,7 @@ def record(func=None, recurse_lock_factory=allocate_lock, **options):
         Added `extended` option.
     """
     if func:
-        return _RecordingFunctionWrapper(func, recurse_lock=recurse_lock_factory(), **options)
+        return _RecordingFunctionWrapper(func, recurse_lock_factory=recurse_lock_factory, **options)
     else:
         return partial(record, **options)
 
@@ -606,7 +617,13 @@ class Replay(_RecordingBase):
         self._strict = strict
         self._dump = dump
         self._context = play._context
-        self._recurse_lock = allocate_lock() if recurse_lock is True else (recurse_lock and recurse_lock())
+        self._recurse_lock_factory = allocate_lock if recurse_lock is True else recurse_lock
+        self._recurse_lock = self._recurse_lock_factory and self._recurse_lock_factory()
+        if self._recurse_lock:
+            register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._recurse_lock = self._recurse_lock_factory()
 
     def _handle(self, binding, name, args, kwargs, wrapped, bind=None):
         pk = self._make_key(binding, name, args, kwargs)
@@ -622,7 +639,8 @@ class Replay(_RecordingBase):
                 raise RuntimeError('Internal failure - unknown result: %r' % result)  # pragma: no cover
         else:
             if self._proxy:
-                shouldrecord = not self._recurse_lock or self._recurse_lock.acquire(False)
+                recurse_lock = self._recurse_lock
+                shouldrecord = not recurse_lock or recurse_lock.acquire(False)
                 try:
                     try:
                         if bind:
@@ -637,8 +655,8 @@ class Replay(_RecordingBase):
                             self._calls[pk] = bind or self._tag_result(name, _Returns(result))
                         return result
                 finally:
-                    if shouldrecord and self._recurse_lock:
-                        self._recurse_lock.release()
+                    if shouldrecord and recurse_lock:
+                        recurse_lock.release()
             else:
                 raise AssertionError("Unexpected call to %s/%s with args:%s kwargs:%s" % pk)
 
@@ -6,6 +6,9 @@ import sys
 from collections import deque
 from functools import wraps
 from inspect import isclass
+from inspect import ismethod
+from itertools import count
+from weakref import WeakMethod
 
 RegexType = type(re.compile(""))
 
@@ -23,6 +26,8 @@ ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
 
 DEBUG = os.getenv('ASPECTLIB_DEBUG')
 
+logger = logging.getLogger(__name__)
+
 
 def logf(logger_func):
     @wraps(logger_func)
@@ -157,3 +162,36 @@ def repr_ex(obj, aliases=()):
         return aliases[ident][0]
     else:
         return repr(obj)
+
+
+_after_fork_callbacks = {}
+_after_fork_counter = count()
+
+
+def register_after_fork(callback):
+    """
+    Registers `callback` to be called (without arguments) in the child process after a ``os.fork()``. Callbacks are called
+    in registration order.
+
+    Bound methods are weakly referenced - the registration goes away when the instance is garbage collected.
+    """
+    key = next(_after_fork_counter)
+    if ismethod(callback):
+        _after_fork_callbacks[key] = WeakMethod(callback, lambda _: _after_fork_callbacks.pop(key, None))
+    else:
+        _after_fork_callbacks[key] = lambda: callback
+    return callback
+
+
+def _run_after_fork():
+    for ref in list(_after_fork_callbacks.values()):
+        callback = ref()
+        if callback is not None:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Failed to run after-fork callback %r.", callback)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_run_after_fork)
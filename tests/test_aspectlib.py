@@ -1,10 +1,18 @@
 # encoding: utf8
+import os
+
+import pytest
 from pytest import raises
 
 import aspectlib
 from aspectlib.test import mock
 from aspectlib.test import record
 
+try:
+    from functools import cached_property
+except ImportError:
+    cached_property = None
+
 
 class Base(object):
     def meth(*_):
@@ -265,6 +273,30 @@ def test_aspect_bind():
     assert called == [True]
 
 
+def test_aspect_subclass_own_init():
+    calls = []
+
+    class Logging(aspectlib.Aspect):
+        def __init__(self, advising_function):
+            self.advising_function = advising_function
+            self.bind = False
+
+        def __call__(self, cutpoint_function):
+            return super(Logging, self).__call__(cutpoint_function)
+
+    def advice(*args):
+        calls.append(args)
+        result = yield
+        yield aspectlib.Return(result * 2)
+
+    @Logging(advice)
+    def func(value):
+        return value
+
+    assert func(3) == 6
+    assert calls == [(3,)]
+
+
 def test_aspect_bad_gen():
     @aspectlib.Aspect
     def aspect():
@@ -363,6 +395,47 @@ def test_aspect_return_but_call():
     assert calls == ['first', 'second']
 
 
+def test_aspect_outermost():
+    calls = []
+
+    @aspectlib.Aspect(outermost=True)
+    def aspect(n):
+        calls.append(n)
+        yield
+
+    @aspect
+    def factorial(n):
+        return n * factorial(n - 1) if n else 1
+
+    @aspect
+    def double_factorial(n):
+        return factorial(n) * 2
+
+    assert factorial(5) == 120
+    assert calls == [5]
+    assert double_factorial(3) == 12
+    assert calls == [5, 3]
+
+
+def test_aspect_outermost_exception():
+    calls = []
+
+    @aspectlib.Aspect(outermost=True)
+    def aspect(n):
+        calls.append(n)
+        yield
+
+    @aspect
+    def countdown(n):
+        if n:
+            return countdown(n - 1)
+        raise ValueError(n)
+
+    raises(ValueError, countdown, 2)
+    raises(ValueError, countdown, 1)
+    assert calls == [2, 1]
+
+
 def test_weave_func():
     with aspectlib.weave(module_func, mock('stuff')):
         assert module_func() == 'stuff'
@@ -564,6 +637,189 @@ def test_weave_instance():
     assert inst.foo == 'stuff'
 
 
+def test_weave_instance_shared():
+    @aspectlib.Aspect
+    def aspect(self, *_):
+        self.foo = 'bar'
+        yield aspectlib.Return
+
+    class Foo(NormalTestClass):
+        pass
+
+    inst = Foo()
+    other = Foo()
+    with aspectlib.weave(inst, aspect, shared=True):
+        assert 'foobar' not in vars(inst)
+        dispatcher = Foo.__dict__['foobar']
+        with aspectlib.weave(other, aspect, shared=True):
+            assert Foo.__dict__['foobar'] is dispatcher
+            other.foobar('stuff')
+            assert other.foo == 'bar'
+        other.foobar('stuff')
+        assert other.foo == 'stuff'
+
+        inst.foobar('stuff')
+        assert inst.foo == 'bar'
+
+    assert 'foobar' not in Foo.__dict__
+    inst.foobar('stuff')
+    assert inst.foo == 'stuff'
+
+
+def test_weave_instance_shared_interleaved_rollback():
+    def tagging(tag):
+        @aspectlib.Aspect
+        def aspect(*_):
+            result = yield aspectlib.Proceed
+            yield aspectlib.Return('%s(%s)' % (tag, result))
+
+        return aspect
+
+    class Foo(object):
+        def m(self):
+            return 'm'
+
+    original = Foo.__dict__['m']
+    a, b = Foo(), Foo()
+    aspect_a, aspect_b = tagging('A'), tagging('B')
+    rollback_a = aspectlib.weave(a, aspect_a, shared=True)
+    rollback_b = aspectlib.weave(b, aspect_b, shared=True)
+    rollback_ab = aspectlib.weave(a, aspect_b, shared=True)
+    dispatcher = Foo.__dict__['m']
+    assert (a.m(), b.m(), Foo().m()) == ('B(A(m))', 'B(m)', 'm')
+
+    rollback_a()
+    assert Foo.__dict__['m'] is dispatcher
+    assert (a.m(), b.m()) == ('B(m)', 'B(m)')
+    rollback_ab()
+    assert (a.m(), b.m()) == ('m', 'B(m)')
+    rollback_b()
+    assert Foo.__dict__['m'] is original
+    assert (a.m(), b.m()) == ('m', 'm')
+
+
+def test_weave_instance_shared_twice():
+    @aspectlib.Aspect
+    def aspect(*_):
+        yield aspectlib.Return('woven')
+
+    class Foo(object):
+        def m(self):
+            return 'm'
+
+    original = Foo.__dict__['m']
+    inst = Foo()
+    with aspectlib.weave(inst, aspect, shared=True):
+        with aspectlib.weave(inst, aspect, shared=True):
+            assert inst.m() == 'woven'
+        assert inst.m() == 'woven'
+    assert inst.m() == 'm'
+    assert Foo.__dict__['m'] is original
+
+
+def test_weave_instance_shared_many_aspects():
+    class Foo(object):
+        def m(self):
+            return 'm'
+
+    original = Foo.__dict__['m']
+    instances = [Foo() for _ in range(10)]
+    rollbacks = [aspectlib.weave(inst, mock(i), shared=True) for i, inst in enumerate(instances)]
+    dispatcher = Foo.__dict__['m']
+    assert [inst.m() for inst in instances] == list(range(10))
+    for rollback in rollbacks[::2]:
+        rollback()
+    assert Foo.__dict__['m'] is dispatcher
+    assert [inst.m() for inst in instances] == ['m', 1, 'm', 3, 'm', 5, 'm', 7, 'm', 9]
+    for rollback in rollbacks[1::2]:
+        rollback()
+    assert Foo.__dict__['m'] is original
+
+
+def test_weave_instance_shared_unhashable():
+    @aspectlib.Aspect
+    def aspect(self, *_):
+        self.foo = 'bar'
+        yield aspectlib.Return
+
+    class Foo(NormalTestClass):
+        __hash__ = None
+
+    inst = Foo()
+    other = Foo()
+    with aspectlib.weave(inst, aspect, shared=True):
+        assert 'foobar' in Foo.__dict__
+        inst.foobar('stuff')
+        assert inst.foo == 'bar'
+        other.foobar('stuff')
+        assert other.foo == 'stuff'
+
+    inst.foobar('stuff')
+    assert inst.foo == 'stuff'
+
+
+def test_weave_instance_shared_identity():
+    class Point(object):
+        def __init__(self, x):
+            self.x = x
+
+        def __eq__(self, other):
+            return isinstance(other, Point) and other.x == self.x
+
+        def __hash__(self):
+            return hash(self.x)
+
+        def m(self):
+            return 'm'
+
+    class UnhashablePoint(Point):
+        __hash__ = None
+
+    woven, equal, unhashable = Point(1), Point(1), UnhashablePoint(1)
+    with aspectlib.weave(woven, mock('woven'), shared=True):
+        assert (woven.m(), equal.m(), unhashable.m()) == ('woven', 'm', 'm')
+    assert woven.m() == 'm'
+
+
+def run_forked(func):
+    pid = os.fork()
+    if not pid:
+        try:
+            os._exit(func())
+        finally:
+            os._exit(255)
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status)
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason="Needs os.register_at_fork")
+def test_weave_after_fork_drop():
+    with aspectlib.weave(module_func, mock(1), after_fork='drop'):
+        assert run_forked(lambda: module_func() or 0) == 0
+        assert module_func() == 1
+    assert module_func() is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason="Needs os.register_at_fork")
+def test_weave_after_fork_reapply():
+    calls = []
+
+    def aspect(func):
+        calls.append(func)
+        return mock(3)(func)
+
+    with aspectlib.weave(module_func, aspect, after_fork='reapply'):
+        assert run_forked(lambda: module_func() + len(calls)) == 5
+        assert module_func() == 3
+    assert module_func() is None
+    assert len(calls) == 1
+
+
+def test_weave_after_fork_bad_option():
+    raises(ValueError, aspectlib.weave, module_func, mock(1), after_fork='bogus')
+    assert module_func() is None
+
+
 def test_weave_subclass_meth_from_baseclass():
     history = []
 
@@ -1128,6 +1384,113 @@ def test_weave_class_old_style_all_magic():
     assert history == []
 
 
+class PropertiesTestClass(object):
+    def __init__(self):
+        self.calls = 0
+        self._value = 'value'
+
+    @property
+    def prop(self):
+        self.calls += 1
+        return self._value
+
+    @prop.setter
+    def prop(self, value):
+        self._value = value
+
+    @prop.deleter
+    def prop(self):
+        self._value = 'deleted'
+
+    if cached_property is not None:
+
+        @cached_property
+        def cached(self):
+            self.calls += 1
+            return 'cached'
+
+    def meth(self):
+        return 'meth'
+
+
+class PropertiesTestSubClass(PropertiesTestClass):
+    pass
+
+
+def test_weave_class_properties_not_by_default():
+    history = []
+    with aspectlib.weave(PropertiesTestClass, record(calls=history)):
+        inst = PropertiesTestClass()
+        assert inst.prop == 'value'
+        if cached_property is not None:
+            assert inst.cached == 'cached'
+        assert inst.meth() == 'meth'
+    assert history == [(inst, (), {})]
+
+
+def test_weave_class_properties():
+    history = []
+    original = PropertiesTestClass.__dict__['prop']
+    with aspectlib.weave(PropertiesTestClass, record(calls=history, extended=True), properties=True):
+        inst = PropertiesTestClass()
+        assert inst.prop == 'value'
+        inst.prop = 'other'
+        del inst.prop
+        assert PropertiesTestClass.prop.__doc__ == original.__doc__
+    assert PropertiesTestClass.__dict__['prop'] is original
+    assert inst.prop == 'deleted'
+    assert [name for _, name, _, _ in history] == [
+        'test_aspectlib.prop',
+        'test_aspectlib.prop',
+        'test_aspectlib.prop',
+    ]
+    assert [args for _, _, args, _ in history] == [(inst,), (inst, 'other'), (inst,)]
+
+
+@pytest.mark.skipif(cached_property is None, reason="functools.cached_property not available")
+def test_weave_class_cached_property():
+    history = []
+    original = PropertiesTestClass.__dict__['cached']
+    with aspectlib.weave(PropertiesTestClass, record(calls=history, extended=True), properties=True):
+        inst = PropertiesTestClass()
+        assert inst.cached == 'cached'
+        assert inst.cached == 'cached'
+        assert inst.calls == 1
+    assert PropertiesTestClass.__dict__['cached'] is original
+    assert [(name, args) for _, name, args, _ in history] == [('test_aspectlib.cached', (inst,))]
+
+
+def test_weave_class_properties_from_base():
+    history = []
+    with aspectlib.weave(PropertiesTestSubClass, record(calls=history), properties=True, subclasses=False):
+        assert PropertiesTestSubClass().prop == 'value'
+        assert PropertiesTestClass().prop == 'value'
+    assert len(history) == 1
+    assert 'prop' not in PropertiesTestSubClass.__dict__
+
+
+def test_weave_class_memoize_properties():
+    history = []
+    with aspectlib.weave(PropertiesTestClass, record(calls=history), memoize_properties=True, methods=['prop']):
+        inst = PropertiesTestClass()
+        assert inst.prop == 'value'
+        assert inst.prop == 'value'
+        assert inst.calls == 1
+        inst.prop = 'other'
+        assert inst.prop == 'other'
+        assert inst.calls == 2
+        inst._value = 'sneaky'
+        assert inst.prop == 'other'
+        PropertiesTestClass.prop.invalidate(inst)
+        assert inst.prop == 'sneaky'
+        del inst.prop
+        assert inst.prop == 'deleted'
+        assert inst.calls == 4
+    inst._value = 'after'
+    assert inst.prop == 'after'
+    assert len(history) == 6
+
+
 def test_just_proceed():
     @aspectlib.Aspect
     def aspect():
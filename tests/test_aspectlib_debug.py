@@ -1,6 +1,12 @@
+import gc
+import json
 import logging
+import os
 import re
+import signal
 import sys
+import threading
+import time
 import weakref
 
 import pytest
@@ -161,3 +167,628 @@ def test_weakref_oldstyle():
         s.add(MyStuff.stuff)
         print(list(s))
     print(list(s))
+
+
+def test_outermost():
+    buf = StringIO()
+
+    @aspectlib.debug.log(print_to=buf, module=False, stacktrace=None, outermost=True)
+    def fib(n):
+        return fib(n - 1) + fib(n - 2) if n > 1 else n
+
+    fib(5)
+    assert buf.getvalue() == 'fib(5)\nfib => 5\n'
+
+
+def test_disabled_logging_skips_formatting():
+    reprs = []
+
+    class Arg(object):
+        def __repr__(self):
+            reprs.append(self)
+            return 'Arg'
+
+    @aspectlib.debug.log(use_logging='DEBUG')
+    def foo(arg):
+        return arg
+
+    level = aspectlib.debug.logger.level
+    aspectlib.debug.logger.setLevel(logging.INFO)
+    try:
+        arg = Arg()
+        assert foo(arg) is arg
+        assert reprs == []
+        aspectlib.debug.logger.setLevel(logging.DEBUG)
+        foo(arg)
+        assert reprs
+    finally:
+        aspectlib.debug.logger.setLevel(level)
+
+
+def test_background():
+    buf = StringIO()
+    logged = aspectlib.debug.log(print_to=buf, module=False, stacktrace=10, background=True)
+    with aspectlib.weave(some_meth, logged):
+        some_meth(1, 2, 3, a=4)
+    logged.flush()
+    assert re.match(LOG_TEST_SIMPLE.replace('test_simple', 'test_background'), buf.getvalue())
+
+
+def test_background_exception():
+    buf = StringIO()
+
+    @aspectlib.debug.log(print_to=buf, module=False, stacktrace=None, background=True, call=False)
+    def foo(arg):
+        raise RuntimeError(arg)
+
+    pytest.raises(RuntimeError, foo, [1])
+    foo.flush()
+    assert buf.getvalue() == "foo([1])\nfoo ~ raised RuntimeError([1])\n"
+
+
+class BlockingFile(object):
+    def __init__(self):
+        self.lines = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, line):
+        self.writing.set()
+        self.release.wait(5)
+        self.lines.append(line)
+
+
+@pytest.mark.parametrize('overflow', ['drop', 'sample'])
+def test_background_overflow(overflow):
+    out = BlockingFile()
+
+    @aspectlib.debug.log(print_to=out, use_logging=None, stacktrace=None, result=False, background=True, queue_size=2, overflow=overflow)
+    def foo(arg):
+        pass
+
+    foo(0)
+    assert out.writing.wait(5)
+    for i in range(1, 21):
+        foo(i)
+    out.release.set()
+    foo.flush()
+    if overflow == 'drop':
+        assert out.lines == ['foo(0)\n', 'foo(1)\n', 'foo(2)\n']
+    else:
+        assert out.lines == ['foo(0)\n', 'foo(2)\n', 'foo(12)\n']
+
+
+def test_background_released():
+    before = set(map(id, aspectlib.debug._background_sinks)) | set(map(id, aspectlib.debug._batched_writers))
+    logged = aspectlib.debug.log(print_to=StringIO(), stacktrace=False, background=True, print_batch_size=100)
+    func = logged(lambda: None)
+    func()
+    logged.flush()
+    (sink,) = [item for item in aspectlib.debug._background_sinks if id(item) not in before]
+    (writer,) = [item for item in aspectlib.debug._batched_writers if id(item) not in before]
+    thread = sink.thread
+    refs = weakref.ref(sink), weakref.ref(writer)
+    del logged, func, sink, writer
+    for _ in range(500):
+        gc.collect()
+        if not any(item() for item in refs):
+            break
+        time.sleep(0.01)
+    assert [item() for item in refs] == [None, None]
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_background_bad_overflow():
+    pytest.raises(ValueError, aspectlib.debug.log, background=True, overflow='bogus')
+
+
+def test_json_lines():
+    buf = StringIO()
+    with aspectlib.weave(MyStuff, aspectlib.debug.log(print_to=buf, stacktrace=5, json_lines=True, use_logging=None)):
+        MyStuff('bar').stuff()
+
+    @aspectlib.debug.log(print_to=buf, stacktrace=None, json_lines=True, call=False, use_logging=None)
+    def foo(*args, **kwargs):
+        raise ValueError('boom')
+
+    pytest.raises(ValueError, foo, 1, a='ă')
+    events = [json.loads(line) for line in buf.getvalue().splitlines()]
+    for event in events:
+        assert event.pop('thread') == threading.get_ident()
+        assert event.pop('task') is None
+        if event['event'] != 'call':
+            assert event.pop('duration_ns') >= 0
+    stack = events[0].pop('stack')
+    assert 'test_json_lines' in [name for _, _, name in stack]
+    assert events == [
+        {'event': 'call', 'name': 'test_aspectlib_debug.MyStuff.stuff', 'args': [], 'kwargs': {}},
+        {'event': 'return', 'name': 'test_aspectlib_debug.MyStuff.stuff', 'result': 'bar'},
+        {'event': 'call', 'name': 'test_aspectlib_debug.test_json_lines.<locals>.foo', 'args': ['1'], 'kwargs': {'a': "'ă'"}},
+        {'event': 'raise', 'name': 'test_aspectlib_debug.test_json_lines.<locals>.foo', 'exception': "ValueError('boom')"},
+    ]
+
+
+def test_bounded_repr():
+    buf = StringIO()
+
+    @aspectlib.debug.log(print_to=buf, module=False, stacktrace=None)
+    def foo(*args, **kwargs):
+        return 'x' * 10000000
+
+    foo(b'x' * 10000000, list(range(10000000)), a=10**10000)
+    call, result = buf.getvalue().splitlines()
+    assert len(call) < 5000
+    assert call.startswith("foo(b'xxxxx")
+    assert "xxx...xxx" in call
+    assert "xxxxx', [0, 1, 2, " in call
+    assert call.endswith(", 99, ...], a=<int with 33220 bits>)")
+    assert result == 'foo => ' + 'x' * 997 + '...'
+
+
+def test_bounded_repr_cache():
+    bounded = aspectlib.debug.BoundedRepr(cache_size=2, maxstring=10)
+    value = ('abc', 1)
+    assert bounded.repr(value) == "('abc', 1)"
+    assert bounded.cache == {id(value): (value, "('abc', 1)")}
+    assert bounded.repr(value) == "('abc', 1)"
+    assert bounded.repr('x' * 100) == "'xx...xxx'"
+    assert len(bounded.cache) == 1
+    bounded.repr(1)
+    bounded.repr(2)
+    assert len(bounded.cache) == 1
+    assert bounded.repr([1]) == '[1]'
+    assert len(bounded.cache) == 1
+    pytest.raises(TypeError, aspectlib.debug.BoundedRepr, bogus=1)
+
+
+def test_format_frames_cache():
+    def call_site():
+        return aspectlib.debug.capture_stack(0, 3)
+
+    frames = [call_site() for _ in range(2)]
+    assert frames[0] == frames[1]
+    text = aspectlib.debug.format_frames(frames[0])
+    assert aspectlib.debug.format_frames(frames[1]) is text
+    assert aspectlib.debug.format_frames(list(frames[1])) is text
+    assert text.startswith('tests/test_aspectlib_debug.py:')
+    assert ':call_site < tests/test_aspectlib_debug.py:' in text
+
+
+def test_stacktrace_stop():
+    buf = StringIO()
+
+    @aspectlib.debug.log(print_to=buf, module=False, stacktrace=100, stacktrace_stop=('_pytest', 'pluggy'))
+    def foo():
+        pass
+
+    foo()
+    call = buf.getvalue().splitlines()[0]
+    assert call.endswith(':test_stacktrace_stop')
+    assert '_pytest' not in call
+
+    assert aspectlib.debug.capture_stack(0, 100, 'test_aspectlib_debug') == ()
+
+
+def test_flight_recorder():
+    buf = StringIO()
+
+    @aspectlib.debug.log(print_to=buf, module=False, stacktrace=False, flight_recorder=3)
+    def foo(fail=False):
+        if fail:
+            raise ValueError('boom')
+        return 'bar'
+
+    for i in range(5):
+        foo()
+    assert buf.getvalue() == ''
+    pytest.raises(ValueError, foo, fail=True)
+    assert buf.getvalue() == "foo => bar\nfoo(fail=True)\nfoo ~ raised ValueError('boom')\n"
+
+    buf.truncate(0)
+    buf.seek(0)
+    foo()
+    foo.dump_flight_recorder()
+    assert buf.getvalue() == 'foo()\nfoo => bar\n'
+
+
+def test_flight_recorder_thread_scope():
+    buf = StringIO()
+
+    @aspectlib.debug.log(print_to=buf, module=False, stacktrace=False, flight_recorder=10, flight_recorder_scope='thread')
+    def foo(arg):
+        if arg == 'fail':
+            raise ValueError('boom')
+
+    def target():
+        foo('thread')
+        pytest.raises(ValueError, foo, 'fail')
+
+    foo('main')
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    assert buf.getvalue() == "foo('thread')\nfoo => None\nfoo('fail')\nfoo ~ raised ValueError('boom')\n"
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason="signal.SIGUSR1 not available")
+def test_flight_recorder_signal():
+    buf = StringIO()
+    previous = signal.signal(signal.SIGUSR1, lambda signum, frame: buf.write('previous handler\n'))
+    try:
+        foo = aspectlib.debug.log(
+            lambda: None, print_to=buf, module=False, stacktrace=False, flight_recorder=10, flight_recorder_signal=signal.SIGUSR1
+        )
+        foo()
+        assert buf.getvalue() == ''
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert buf.getvalue() == 'previous handler\n'
+        foo()
+        assert buf.getvalue() == 'previous handler\n<lambda>()\n<lambda> => None\n'
+        foo.dump_flight_recorder()
+        assert buf.getvalue() == 'previous handler\n' + '<lambda>()\n<lambda> => None\n' * 2
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason="signal.SIGUSR1 not available")
+def test_flight_recorder_signal_background():
+    buf = StringIO()
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        foo = aspectlib.debug.log(
+            lambda: None, print_to=buf, module=False, stacktrace=False, flight_recorder=10, flight_recorder_signal=signal.SIGUSR1,
+            background=True
+        )
+        foo()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        for _ in range(500):
+            if buf.getvalue():
+                break
+            time.sleep(0.01)
+        foo.flush()
+        assert buf.getvalue() == '<lambda>()\n<lambda> => None\n'
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1') or not hasattr(os, 'fork'), reason="Needs signal.SIGUSR1 and os.fork")
+def test_flight_recorder_signal_while_writing():
+    class SignallingFile(CountingFile):
+        def write(self, text):
+            if not self.writes:
+                os.kill(os.getpid(), signal.SIGUSR1)  # the handler runs while the output lock is held
+            return super(SignallingFile, self).write(text)
+
+    pid = os.fork()
+    if not pid:
+        try:
+            signal.alarm(5)
+            out = SignallingFile()
+            foo = aspectlib.debug.log(
+                lambda: None, print_to=out, module=False, stacktrace=False, flight_recorder=10,
+                flight_recorder_signal=signal.SIGUSR1, print_batch_size=1, print_batch_delay=None
+            )
+            foo()
+            foo.dump_flight_recorder()
+            foo()
+            os._exit(0 if out.getvalue() == '<lambda>()\n<lambda> => None\n' else 1)
+        finally:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_flight_recorder_bad_scope():
+    pytest.raises(ValueError, aspectlib.debug.log, flight_recorder=10, flight_recorder_scope='bogus')
+
+
+def test_timing():
+    buf = StringIO()
+    timed = aspectlib.debug.log(print_to=buf, module=False, stacktrace=False, timing=True)
+
+    @timed
+    def foo(fail=False):
+        if fail:
+            raise ValueError('boom')
+        return 'bar'
+
+    @timed
+    def gen():
+        yield 1
+        yield 2
+
+    foo()
+    pytest.raises(ValueError, foo, fail=True)
+    assert list(gen()) == [1, 2]
+    assert re.match(r"""foo\(\)
+foo => bar \(\d+(ns|\.\dus)\)
+foo\(fail=True\)
+foo ~ raised ValueError\('boom'\) \(\d+(ns|\.\dus)\)
+gen\(\)
+gen => None \(\d+(ns|\.\dus)\)
+$""", buf.getvalue())
+
+    histograms = timed.histograms()
+    assert sorted(histograms) == ['test_aspectlib_debug.test_timing.<locals>.foo', 'test_aspectlib_debug.test_timing.<locals>.gen']
+    foo_histogram = histograms['test_aspectlib_debug.test_timing.<locals>.foo']
+    assert foo_histogram.count == 2
+    assert 0 < foo_histogram.min <= foo_histogram.percentile(50) <= foo_histogram.max
+
+    buf.truncate(0)
+    buf.seek(0)
+    timed.dump_histograms()
+    assert re.match(r"""test_aspectlib_debug.test_timing.<locals>.foo: count=2 mean=\S+ min=\S+ p50=\S+ p90=\S+ p99=\S+ p99.9=\S+ max=\S+
+test_aspectlib_debug.test_timing.<locals>.gen: count=1 """, buf.getvalue())
+
+
+def test_timing_disabled_logging():
+    logger = logging.getLogger('aspectlib.debug')
+    level = logger.level
+    logger.setLevel(logging.CRITICAL + 1)
+    try:
+        timed = aspectlib.debug.log(stacktrace=False, timing=True)
+        foo = timed(lambda: 'bar')
+        for _ in range(3):
+            assert foo() == 'bar'
+    finally:
+        logger.setLevel(level)
+    (histogram,) = timed.histograms().values()
+    assert histogram.count == 3
+
+
+def test_latency_histogram():
+    histogram = aspectlib.debug.LatencyHistogram(precision=4)
+    assert histogram.percentile(50) == 0
+    for ns in [1, 5, 17, 1000, 1001, 1000000]:
+        histogram.record(ns)
+    assert sorted(histogram.counts.items()) == [(1, 1), (5, 1), (16, 1), (960, 2), (983040, 1)]
+    assert histogram.percentile(50) == 17
+    assert histogram.percentile(80) == 1023
+    assert histogram.percentile(100) == 1000000
+    histogram.reset()
+    assert histogram.count == 0
+    assert histogram.snapshot()['max'] == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason="Needs os.register_at_fork")
+def test_latency_histogram_after_fork():
+    histogram = aspectlib.debug.LatencyHistogram()
+    histogram.record(1000)
+    timed = aspectlib.debug.log(print_to=StringIO(), stacktrace=False, timing=True)
+    func = timed(lambda: 'func')
+    func()
+    locks = [histogram.lock, aspectlib.debug._histograms_lock]
+    for lock in locks:
+        lock.acquire()  # as if other threads were recording at fork time
+    try:
+        pid = os.fork()
+        if not pid:
+            try:
+                signal.alarm(5)
+                histogram.record(2000)
+                func()
+                counts = [histogram.count] + [item.count for item in timed.histograms().values()]
+                os._exit(0 if counts == [1, 1] and histogram.min == 2000 else 1)
+            finally:
+                os._exit(2)
+    finally:
+        for lock in locks:
+            lock.release()
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert histogram.count == 1
+
+
+def test_bound_wrapper_reused():
+    buf = StringIO()
+
+    class Stuff(MyStuff):
+        @aspectlib.debug.log(print_to=buf, module=False, stacktrace=False, attributes=('foo',))
+        def meth(self, arg):
+            return self.foo + arg
+
+        @classmethod
+        @aspectlib.debug.log(print_to=buf, module=False, stacktrace=False)
+        def cmeth(cls):
+            return cls.__name__
+
+    first, second = Stuff('a'), Stuff('b')
+    assert first.meth.__func__ is second.meth.__func__
+    assert first.meth == first.meth
+    assert first.meth.__name__ == 'meth'
+    assert first.meth('1') == 'a1'
+    assert second.meth('2') == 'b2'
+    assert Stuff.meth(first, '3') == 'a3'
+    assert Stuff.cmeth() == 'Stuff'
+    assert buf.getvalue() == (
+        "{Stuff foo='a'}.meth('1')\n{Stuff foo='a'}.meth => a1\n"
+        "{Stuff foo='b'}.meth('2')\n{Stuff foo='b'}.meth => b2\n"
+        "meth(<test_aspectlib_debug.test_bound_wrapper_reused.<locals>.Stuff object at %#x>, '3')\nmeth => a3\n"
+        "{type}.cmeth()\n{type}.cmeth => Stuff\n" % id(first)
+    )
+
+
+def test_trace():
+    buf = StringIO()
+    traced = aspectlib.debug.log(print_to=buf, module=False, stacktrace=False, trace=True)
+
+    @traced
+    def leaf(n):
+        if n < 0:
+            raise ValueError(n)
+        return n
+
+    @traced
+    def gen():
+        yield leaf(1)
+
+    @traced
+    def root():
+        try:
+            leaf(-1)
+        except ValueError:
+            pass
+        return leaf(2) + sum(gen())
+
+    root()
+    lines = buf.getvalue().splitlines()
+    times = r' \(\S+ total, \S+ self\)$'
+    expected = [
+        r'root\(\)$',
+        r'  leaf\(-1\)$',
+        r'  leaf ~ raised ValueError\(-1\)' + times,
+        r'  leaf\(2\)$',
+        r'  leaf => 2' + times,
+        r'  gen\(\)$',
+        r'  leaf\(1\)$',
+        r'  leaf => 1' + times,
+        r'  gen => None' + times,
+        r'root => 3' + times,
+    ]
+    assert len(lines) == len(expected)
+    for line, pattern in zip(lines, expected):
+        assert re.match(pattern, line), line
+
+
+def test_trace_interrupted():
+    buf = StringIO()
+    traced = aspectlib.debug.log(print_to=buf, module=False, stacktrace=False, trace=True, timing=True)
+
+    @traced
+    def interrupted():
+        raise KeyboardInterrupt()
+
+    @traced
+    def func():
+        return 'ok'
+
+    pytest.raises(KeyboardInterrupt, interrupted)
+    assert func() == 'ok'
+    lines = buf.getvalue().splitlines()
+    assert lines[:2] == ['interrupted()', 'func()']
+    assert lines[2].startswith('func => ok (')
+    assert sorted(histogram.count for histogram in traced.histograms().values()) == [1, 1]
+
+
+def test_trace_json_lines():
+    buf = StringIO()
+    traced = aspectlib.debug.log(print_to=buf, stacktrace=False, trace=True, json_lines=True, use_logging=None)
+
+    @traced
+    def child():
+        time.sleep(0.01)
+
+    @traced
+    def parent():
+        child()
+
+    def target():
+        parent()
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    parent_call, child_call, child_return, parent_return = [json.loads(line) for line in buf.getvalue().splitlines()]
+    assert parent_call['parent'] is None
+    assert parent_call['depth'] == 0
+    assert child_call['parent'] == parent_call['id'] == parent_return['id']
+    assert child_call['depth'] == 1
+    assert child_return['id'] == child_call['id']
+    assert child_return['exclusive_ns'] == child_return['duration_ns'] >= 10000000
+    assert parent_return['duration_ns'] - parent_return['exclusive_ns'] == child_return['duration_ns']
+
+
+class CountingFile(StringIO):
+    def __init__(self):
+        super(CountingFile, self).__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super(CountingFile, self).write(text)
+
+
+def test_print_batch():
+    out = CountingFile()
+
+    @aspectlib.debug.log(print_to=out, module=False, stacktrace=False, print_batch_size=100, print_batch_delay=None)
+    def foo(fail=False):
+        if fail:
+            raise ValueError('boom')
+
+    for _ in range(10):
+        foo()
+    assert out.writes == 1
+    assert out.getvalue() == 'foo()\nfoo => None\n' * 6
+    pytest.raises(ValueError, foo, fail=True)
+    assert out.writes == 2
+    assert out.getvalue().count('foo => None') == 10
+    assert out.getvalue().endswith("foo => None\nfoo(fail=True)\nfoo ~ raised ValueError('boom')\n")
+    foo()
+    foo.flush()
+    assert out.writes == 3
+    assert out.getvalue().endswith('foo()\nfoo => None\n')
+
+
+def test_print_batch_delay():
+    out = CountingFile()
+    foo = aspectlib.debug.log(lambda: None, print_to=out, module=False, stacktrace=False, print_batch_size=10000, print_batch_delay=0.01)
+    foo()
+    foo()
+    assert out.writes == 0
+    for _ in range(500):
+        if out.writes:
+            break
+        time.sleep(0.01)
+    assert out.writes == 1
+    assert out.getvalue() == '<lambda>()\n<lambda> => None\n' * 2
+
+    other = aspectlib.debug.log(lambda: None, print_to=out, module=False, stacktrace=False, print_batch_size=10000, print_batch_delay=0.01)
+    foo()
+    other()
+    for _ in range(500):
+        if out.writes == 3:
+            break
+        time.sleep(0.01)
+    assert out.writes == 3
+    assert [thread.name for thread in threading.enumerate()].count('aspectlib.debug.flusher') == 1
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason="Needs os.register_at_fork")
+def test_print_batch_after_fork():
+    out = CountingFile()
+    writer = aspectlib.debug._BatchedWriter(out, 10000, None)
+    writer.write('parent\n')
+    writer.lock.acquire()  # as if another thread was writing at fork time
+    try:
+        pid = os.fork()
+        if not pid:
+            try:
+                signal.alarm(5)
+                writer.write('child\n')
+                writer.flush()
+                os._exit(0 if out.getvalue() == 'child\n' else 1)
+            finally:
+                os._exit(2)
+    finally:
+        writer.lock.release()
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    writer.flush()
+    assert out.getvalue() == 'parent\n'
+
+
+def test_print_batch_background():
+    out = CountingFile()
+
+    @aspectlib.debug.log(print_to=out, module=False, stacktrace=False, background=True, print_batch_size=10000, print_batch_delay=None)
+    def foo():
+        raise ValueError('boom')
+
+    pytest.raises(ValueError, foo)
+    for _ in range(500):
+        if out.writes:
+            break
+        time.sleep(0.01)
+    assert out.getvalue() == "foo()\nfoo ~ raised ValueError('boom')\n"
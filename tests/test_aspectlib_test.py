@@ -1,3 +1,6 @@
+import os
+
+import pytest
 from pytest import raises
 from test_pkg1.test_pkg2 import test_mod
 
@@ -199,6 +202,23 @@ def test_record_not_iscalled_and_results():
     record(module_fun, iscalled=True, results=False)
 
 
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason="Needs os.register_at_fork")
+def test_record_after_fork():
+    fun = record(module_fun)
+    fun._RecordingFunctionWrapper__recurse_lock.acquire()  # as if another thread was in a recorded call at fork time
+    pid = os.fork()
+    if not pid:
+        try:
+            fun(1)
+            os._exit(0 if fun.calls[-1].args == (1,) else 1)
+        finally:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    fun(2)
+    assert fun.calls == []
+
+
 def test_story_empty_play_noproxy():
     with Story(test_mod).replay(recurse_lock=True, proxy=False, strict=False) as replay:
         raises(AssertionError, test_mod.target)
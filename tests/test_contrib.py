@@ -1,7 +1,17 @@
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
 import pytest
 
+import aspectlib
 from aspectlib import contrib
 from aspectlib.contrib import retry
 from aspectlib.test import LogCapture
@@ -130,3 +140,896 @@ def test_with_class():
         ('INFO', 'connected!'),
         ('INFO', 'action!'),
     ]
+
+
+async def flaky_coro(arg):
+    await asyncio.sleep(0)
+    flaky_func(arg)
+    return 'done'
+
+
+def test_coroutine():
+    calls = []
+    assert asyncio.run(retry(sleep=calls.append, backoff=1.5)(flaky_coro)([None] * 5)) == 'done'
+    assert calls == [1.5, 1.5, 1.5, 1.5, 1.5]
+
+    calls = []
+    pytest.raises(OSError, asyncio.run, retry(sleep=calls.append, retries=1)(flaky_coro)([None, None]))
+    assert calls == [0]
+
+
+def test_coroutine_does_not_block_loop():
+    ticks = []
+    cleanups = []
+
+    async def cleanup(arg):
+        await asyncio.sleep(0)
+        cleanups.append(len(arg))
+
+    async def ticker():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0.001)
+
+    async def main():
+        task = asyncio.ensure_future(ticker())
+        try:
+            return await retry(backoff=0.05, cleanup=cleanup)(flaky_coro)([None] * 2)
+        finally:
+            task.cancel()
+
+    assert asyncio.run(main()) == 'done'
+    assert len(ticks) > 10
+    assert cleanups == [1, 0]
+
+
+def test_coroutine_cancel_during_backoff():
+    attempts = []
+
+    @retry(backoff=10)
+    async def failing():
+        attempts.append(1)
+        raise OSError('Tough luck!')
+
+    async def main():
+        task = asyncio.ensure_future(failing())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert attempts == [1]
+
+
+def test_jitter_backoffs():
+    for count in range(10):
+        assert 0 <= retry.full_jitter_backoff(count) <= min(60, 2 ** count)
+        assert min(60, 2 ** count) / 2 <= retry.equal_jitter_backoff(count) <= min(60, 2 ** count)
+    assert retry.full_jitter_backoff(100, cap=5) <= 5
+
+    timeouts = [retry.decorrelated_jitter_backoff(count, base=0.1, cap=10) for count in range(10)]
+    assert all(0.1 <= timeout <= 10 for timeout in timeouts)
+    for previous, timeout in zip(timeouts, timeouts[1:]):
+        assert timeout <= previous * 3
+    assert retry.decorrelated_jitter_backoff(0, base=0.1, cap=10) <= 0.3
+
+
+def test_retry_budget():
+    now = [0]
+    budget = contrib.RetryBudget(capacity=3, rate=0.5, clock=lambda: now[0])
+    calls = []
+    first = retry(sleep=calls.append, budget=budget)(flaky_func)
+    second = retry(sleep=calls.append, budget=budget)(flaky_func)
+
+    first([None] * 2)
+    assert calls == [0, 0]
+    pytest.raises(OSError, second, [None] * 2)
+    assert calls == [0, 0, 0]
+    now[0] = 2
+    second([None])
+    assert calls == [0, 0, 0, 0]
+    assert budget.tokens == 0
+
+
+def test_retry_budget_coroutine():
+    budget = contrib.RetryBudget(capacity=1, rate=0)
+    calls = []
+    pytest.raises(OSError, asyncio.run, retry(sleep=calls.append, budget=budget)(flaky_coro)([None] * 3))
+    assert calls == [0]
+
+
+def test_circuit_breaker():
+    now = [0]
+    breaker = contrib.CircuitBreaker(
+        failure_ratio=0.5, minimum_calls=4, window=10, buckets=5, reset_timeout=30, half_open_calls=2, clock=lambda: now[0]
+    )
+
+    class Client(object):
+        def __init__(self):
+            self.fail = False
+            self.calls = 0
+
+        def get(self):
+            self.calls += 1
+            if self.fail:
+                raise OSError('down')
+            return 'ok'
+
+        def bad_arg(self):
+            raise ValueError('bad')
+
+    with aspectlib.weave(Client, breaker):
+        client = Client()
+        assert client.get() == 'ok'
+        pytest.raises(ValueError, client.bad_arg)
+        client.fail = True
+        pytest.raises(OSError, client.get)
+        assert breaker.state == 'closed'
+        pytest.raises(OSError, client.get)
+        assert breaker.state == 'open'
+        pytest.raises(contrib.CircuitOpenError, client.get)
+        pytest.raises(contrib.CircuitOpenError, client.bad_arg)
+        assert client.calls == 3
+
+        now[0] = 30
+        pytest.raises(OSError, client.get)
+        assert breaker.state == 'open'
+        pytest.raises(contrib.CircuitOpenError, client.get)
+
+        now[0] = 60
+        client.fail = False
+        assert client.get() == 'ok'
+        assert breaker.state == 'half-open'
+        assert client.get() == 'ok'
+        assert breaker.state == 'closed'
+        assert client.calls == 6
+
+        # old failures drop out of the window
+        client.fail = True
+        for _ in range(3):
+            pytest.raises(OSError, client.get)
+            now[0] += 10
+        assert breaker.state == 'closed'
+
+
+def test_circuit_breaker_half_open_limit():
+    breaker = contrib.CircuitBreaker(minimum_calls=1, reset_timeout=0, half_open_calls=1)
+    entered = []
+
+    @breaker
+    def fail():
+        raise OSError('down')
+
+    @breaker
+    def reenter():
+        entered.append(1)
+        pytest.raises(contrib.CircuitOpenError, reenter)
+
+    pytest.raises(OSError, fail)
+    assert breaker.state == 'open'
+    reenter()
+    assert entered == [1]
+    assert breaker.state == 'closed'
+    breaker.reset()
+    assert breaker.state == 'closed'
+
+
+def test_circuit_breaker_coroutine():
+    breaker = contrib.CircuitBreaker(minimum_calls=2, reset_timeout=0.05)
+
+    @breaker
+    async def fetch(fail):
+        await asyncio.sleep(0)
+        if fail:
+            raise OSError('down')
+        return 'ok'
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(OSError):
+                await fetch(True)
+        with pytest.raises(contrib.CircuitOpenError):
+            await fetch(False)
+        await asyncio.sleep(0.06)
+        return await fetch(False)
+
+    assert asyncio.run(main()) == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_timeout_threaded():
+    release = threading.Event()
+    abandoned = contrib.timeout.abandoned.running
+
+    @contrib.timeout(seconds=0.05, threaded=True)
+    def slow(arg):
+        release.wait(5)
+        return arg
+
+    @contrib.timeout(seconds=1, threaded=True)
+    def fast(arg):
+        return threading.current_thread().name, arg, contrib.remaining_time()
+
+    name, arg, remaining = fast(1)
+    assert name == 'aspectlib.contrib.timeout:fast'
+    assert arg == 1
+    assert 0 < remaining <= 1
+    pytest.raises(ZeroDivisionError, contrib.timeout(seconds=1, threaded=True)(lambda: 1 / 0))
+    with pytest.raises(TimeoutError, match='slow: deadline exceeded'):
+        slow(2)
+    assert contrib.timeout.abandoned.running == abandoned + 1
+    release.set()
+    for _ in range(500):
+        if contrib.timeout.abandoned.running == abandoned:
+            break
+        time.sleep(0.01)
+    assert contrib.timeout.abandoned.running == abandoned
+
+
+def test_timeout_propagates():
+    remaining = []
+
+    @contrib.timeout(seconds=10)
+    def inner():
+        remaining.append(contrib.remaining_time())
+
+    @contrib.timeout(seconds=0.5)
+    def outer():
+        inner()
+        time.sleep(0.5)
+        inner()
+
+    assert contrib.remaining_time() is None
+    pytest.raises(TimeoutError, outer)
+    assert len(remaining) == 1
+    assert 0 < remaining[0] <= 0.5
+    assert contrib.remaining_time() is None
+    inner()
+    assert 9 < remaining[-1] <= 10
+
+
+def test_timeout_coroutine():
+    remaining = []
+
+    @contrib.timeout(seconds=10)
+    async def inner(delay):
+        remaining.append(contrib.remaining_time())
+        await asyncio.sleep(delay)
+        return delay
+
+    @contrib.timeout(seconds=0.2)
+    async def outer(delay):
+        return await inner(delay)
+
+    assert asyncio.run(outer(0)) == 0
+    assert 0 < remaining[0] <= 0.2
+    with pytest.raises(TimeoutError, match='deadline exceeded'):
+        asyncio.run(outer(1))
+
+    @contrib.timeout(seconds=1)
+    async def raises_own_timeout():
+        raise TimeoutError('mine')
+
+    with pytest.raises(TimeoutError, match='mine'):
+        asyncio.run(raises_own_timeout())
+
+
+def test_cache():
+    now = [0]
+    cache = contrib.Cache(maxsize=3, ttl=10, clock=lambda: now[0])
+    calls = []
+
+    @cache
+    def func(*args, **kwargs):
+        calls.append((args, kwargs))
+        return len(calls)
+
+    assert func(1) == 1
+    assert func(1) == 1
+    assert func(1, a=2) == 2
+    assert func(1, a=2) == 2
+    assert func([1, {'a': 2}]) == 3
+    assert func([1, {'a': 2}]) == 3
+    assert cache.stats() == {'hits': 3, 'misses': 3, 'evictions': 0, 'size': 3}
+    assert func(2) == 4
+    assert cache.stats()['evictions'] == 1
+    assert func(1) == 5  # evicted as least recently used
+    now[0] = 10
+    assert func(1) == 6  # expired
+    assert cache.stats() == {'hits': 3, 'misses': 6, 'evictions': 3, 'size': 3}
+    pytest.raises(ZeroDivisionError, cache(lambda: 1 / 0))
+    cache.clear()
+    assert cache.stats()['size'] == 0
+    pytest.raises(ValueError, contrib.Cache, scope='bogus')
+
+    def gen():
+        yield
+
+    pytest.raises(TypeError, cache, gen)
+
+
+def test_cache_scopes():
+    class Lookup(object):
+        calls = 0
+
+        def get(self, key):
+            Lookup.calls += 1
+            return key, Lookup.calls
+
+    instance_cache = contrib.Cache(scope='instance')
+    with aspectlib.weave(Lookup, instance_cache):
+        first, second = Lookup(), Lookup()
+        assert first.get('a') == ('a', 1)
+        assert first.get('a') == ('a', 1)
+        assert second.get('a') == ('a', 2)
+        assert instance_cache.stats()['size'] == 2
+        del first
+        assert instance_cache.stats()['size'] == 1
+
+    class_cache = contrib.Cache(scope='class')
+    with aspectlib.weave(Lookup, class_cache):
+        assert Lookup().get('a') == ('a', 3)
+        assert Lookup().get('a') == ('a', 3)
+
+
+def test_cache_scope_instance_identity():
+    class Point(object):
+        calls = 0
+
+        def __init__(self, x):
+            self.x = x
+
+        def __eq__(self, other):
+            return isinstance(other, Point) and self.x == other.x
+
+        def __hash__(self):
+            return hash(self.x)
+
+        def get(self):
+            Point.calls += 1
+            return self.x, Point.calls
+
+    class UnhashablePoint(Point):
+        __hash__ = None
+
+    cache = contrib.Cache(scope='instance')
+    with aspectlib.weave(Point, cache):
+        first, second = Point(1), Point(1)
+        assert first.get() == (1, 1)
+        assert second.get() == (1, 2)
+        assert first.get() == (1, 1)
+        unhashable = UnhashablePoint(1)
+        assert unhashable.get() == (1, 3)
+        assert unhashable.get() == (1, 3)
+        assert cache.stats()['size'] == 3
+        del first, unhashable
+        assert cache.stats()['size'] == 1
+
+
+def test_cache_scopes_not_methods():
+    class Parser(object):
+        @staticmethod
+        def parse(text):
+            return text.upper()
+
+        @classmethod
+        def name(cls):
+            return cls.__name__
+
+    class SubParser(Parser):
+        pass
+
+    for scope in 'instance', 'class':
+        cache = contrib.Cache(scope=scope)
+        with aspectlib.weave(Parser, cache):
+            assert (Parser.parse('a'), Parser.parse('b')) == ('A', 'B')
+            assert (Parser().parse('c'), Parser().parse('d')) == ('C', 'D')
+            assert (Parser.name(), SubParser.name(), Parser().name()) == ('Parser', 'SubParser', 'Parser')
+        assert cache.stats()['hits'] == 1
+
+        @cache
+        def upper(text):
+            return text.upper()
+
+        assert (upper('a'), upper('b'), upper('a')) == ('A', 'B', 'A')
+
+
+def test_cache_coroutine():
+    cache = contrib.Cache()
+    calls = []
+
+    @cache
+    async def fetch(key):
+        await asyncio.sleep(0)
+        calls.append(key)
+        return key * 2
+
+    async def main():
+        return [await fetch(1), await fetch(1), await fetch(2)]
+
+    assert asyncio.run(main()) == [2, 2, 4]
+    assert asyncio.run(main()) == [2, 2, 4]
+    assert calls == [1, 2]
+
+
+def test_single_flight_threads():
+    single_flight = contrib.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @single_flight
+    def load(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        if key == 'bad':
+            raise KeyError(key)
+        return key.upper()
+
+    def run(key, results):
+        try:
+            results.append(load(key))
+        except KeyError as exc:
+            results.append(exc)
+
+    for key in ['a', 'bad']:
+        started.clear()
+        release.clear()
+        results = []
+        leader = threading.Thread(target=run, args=(key, results))
+        leader.start()
+        assert started.wait(5)
+        followers = [threading.Thread(target=run, args=(key, results)) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        for _ in range(5000):
+            if single_flight.coalesced == (3 if key == 'a' else 6):
+                break
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        if key == 'a':
+            assert results == ['A'] * 4
+        else:
+            assert len(results) == 4
+            assert all(result is results[0] for result in results)
+            assert isinstance(results[0], KeyError)
+    assert calls == ['a', 'bad']
+    assert single_flight.coalesced == 6
+    assert single_flight.flights == {}
+    assert load('a') == 'A'
+    assert calls == ['a', 'bad', 'a']
+
+
+def test_single_flight_coroutine_cancel():
+    single_flight = contrib.SingleFlight()
+    calls = []
+
+    @single_flight
+    async def load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key.upper()
+
+    async def main():
+        first = asyncio.ensure_future(load('a'))
+        second = asyncio.ensure_future(load('a'))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == 'A'
+    assert calls == ['a']
+    assert single_flight.coalesced == 1
+    assert single_flight.tasks == {}
+
+
+def test_micro_batch_threads():
+    batches = []
+
+    def get_many(keys):
+        batches.append(keys)
+        return [ValueError(key) if key == 'bad' else key.upper() for key in keys]
+
+    batch = contrib.MicroBatch(get_many, max_size=3, delay=5)
+
+    @batch
+    def get(key):
+        raise AssertionError('not called')
+
+    results = {}
+
+    def run(key):
+        try:
+            results[key] = get(key)
+        except ValueError as exc:
+            results[key] = exc
+
+    threads = [threading.Thread(target=run, args=(key,)) for key in ['a', 'bad', 'a', 'b']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert [sorted(keys) for keys in batches] == [['a', 'b', 'bad']]
+    assert results['a'] == 'A'
+    assert results['b'] == 'B'
+    assert isinstance(results['bad'], ValueError)
+    assert batch.batches == 1
+    assert batch.batch is None
+
+    batch.delay = 0
+    batch.bulk_function = lambda keys: {}
+    pytest.raises(KeyError, get, 'missing')
+    pytest.raises(TypeError, batch, lambda: (yield))
+
+
+def test_micro_batch_threads_base_exception():
+    class Interrupted(BaseException):
+        pass
+
+    def get_many(keys):
+        raise Interrupted()
+
+    batch = contrib.MicroBatch(get_many, max_size=2, delay=5)
+
+    @batch
+    def get(key):
+        raise AssertionError('not called')
+
+    results = {}
+
+    def run(key):
+        try:
+            results[key] = get(key)
+        except BaseException as exc:
+            results[key] = exc
+
+    threads = [threading.Thread(target=run, args=(key,)) for key in 'ab']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert isinstance(results['a'], Interrupted)
+    assert isinstance(results['b'], Interrupted)
+
+
+def test_micro_batch_coroutine():
+    batches = []
+
+    async def get_many(keys):
+        batches.append(keys)
+        await asyncio.sleep(0)
+        if 'error' in keys:
+            raise RuntimeError('bulk failed')
+        return {key: key * 2 for key in keys}
+
+    batch = contrib.MicroBatch(get_many, max_size=2, delay=0.01)
+
+    @batch
+    async def get(key):
+        raise AssertionError('not called')
+
+    async def main():
+        assert await asyncio.gather(get(1), get(2), get(3), get(1)) == [2, 4, 6, 2]
+        with pytest.raises(RuntimeError):
+            await get('error')
+
+    asyncio.run(main())
+    assert batches == [[1, 2], [3, 1], ['error']]
+    assert batch.batches == 3
+
+
+def test_micro_batch_coroutine_cancelled():
+    async def get_many(keys):
+        await asyncio.sleep(0)
+        raise asyncio.CancelledError()
+
+    batch = contrib.MicroBatch(get_many, max_size=2, delay=5)
+
+    @batch
+    async def get(key):
+        raise AssertionError('not called')
+
+    async def main():
+        results = await asyncio.wait_for(asyncio.gather(get(1), get(2), return_exceptions=True), 5)
+        assert [type(result) for result in results] == [asyncio.CancelledError, asyncio.CancelledError]
+
+    asyncio.run(main())
+    assert batch.batches == 1
+
+
+def test_bulkhead_threads():
+    bulkhead = contrib.Bulkhead(max_concurrent=1, max_queued=1, queue_timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @bulkhead
+    def call(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return key
+
+    first = threading.Thread(target=call, args=('first',))
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=call, args=('second',))
+    second.start()
+    for _ in range(5000):
+        if bulkhead.queued:
+            break
+        time.sleep(0.001)
+    assert (bulkhead.in_flight, bulkhead.queued) == (1, 1)
+    pytest.raises(contrib.BulkheadFullError, call, 'rejected')
+    release.set()
+    first.join()
+    second.join()
+    assert calls == ['first', 'second']
+    assert (bulkhead.in_flight, bulkhead.queued, bulkhead.rejected) == (0, 0, 1)
+
+    bulkhead.queue_timeout = 0.01
+    release.clear()
+    first = threading.Thread(target=call, args=('first',))
+    first.start()
+    for _ in range(5000):
+        if bulkhead.in_flight:
+            break
+        time.sleep(0.001)
+    pytest.raises(contrib.BulkheadFullError, call, 'timed out')
+    release.set()
+    first.join()
+    assert (bulkhead.in_flight, bulkhead.queued, bulkhead.rejected) == (0, 0, 2)
+
+
+def test_bulkhead_coroutine():
+    bulkhead = contrib.Bulkhead(max_concurrent=2, max_queued=10)
+    running = []
+    peak = []
+
+    @bulkhead
+    async def call(key):
+        running.append(key)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(key)
+        return key
+
+    async def main():
+        tasks = [asyncio.ensure_future(call(key)) for key in range(6)]
+        await asyncio.sleep(0)
+        assert (bulkhead.in_flight, bulkhead.queued) == (2, 4)
+        tasks[2].cancel()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert results[:2] == [0, 1]
+    assert isinstance(results[2], asyncio.CancelledError)
+    assert results[3:] == [3, 4, 5]
+    assert max(peak) == 2
+    assert (bulkhead.in_flight, bulkhead.queued) == (0, 0)
+
+
+def test_bulkhead_weave_class():
+    bulkhead = contrib.Bulkhead(max_concurrent=1)
+
+    class Client(object):
+        def get(self):
+            return self.fetch()
+
+        def fetch(self):
+            return bulkhead.in_flight
+
+    with aspectlib.weave(Client, bulkhead):
+        client = Client()
+        assert client.get() == 1
+        assert client.fetch() == 1
+        assert bulkhead.in_flight == 0
+
+    async def agen():
+        yield
+
+    def gen():
+        yield
+
+    pytest.raises(TypeError, bulkhead, agen)
+    pytest.raises(TypeError, bulkhead, gen)
+
+
+def test_bulkhead_child_tasks():
+    bulkhead = contrib.Bulkhead(max_concurrent=2, max_queued=20)
+    peak = []
+
+    class Client(object):
+        async def fetch_many(self, keys):
+            assert self.key(0) == 0  # same task, passes through
+            return await asyncio.gather(*(self.fetch(key) for key in keys))
+
+        async def fetch(self, key):
+            peak.append(bulkhead.in_flight)
+            await asyncio.sleep(0.001)
+            return self.key(key)
+
+        def key(self, key):
+            return key
+
+    with aspectlib.weave(Client, bulkhead):
+        assert asyncio.run(Client().fetch_many(range(20))) == list(range(20))
+    assert max(peak) == 2
+    assert (bulkhead.in_flight, bulkhead.queued, bulkhead.holders) == (0, 0, set())
+
+
+def test_adaptive_concurrency():
+    now = [0.0]
+    latency = [1.0]
+
+    def clock():
+        now[0] += latency[0]
+        return now[0]
+
+    limiter = contrib.AdaptiveConcurrency(initial_limit=2, max_limit=4, probe_interval=50, exceptions=(OSError,), clock=clock)
+
+    @limiter
+    def call(exception=None):
+        if exception:
+            raise exception
+
+    for _ in range(10):
+        call()
+    assert limiter.limit == 3  # grew while the limit was used, stopped growing afterwards
+    assert (limiter.latency, limiter.min_latency) == (1.0, 1.0)
+
+    pytest.raises(OSError, call, OSError())
+    assert limiter.limit == 2
+    pytest.raises(ValueError, call, ValueError())  # not an overload signal
+    assert limiter.limit == 3
+
+    latency[0] = 5.0
+    for _ in range(10):
+        call()
+    assert limiter.limit == 1
+    assert limiter.latency > 4
+    assert limiter.min_latency == 1.0
+    for _ in range(30):
+        call()
+    assert limiter.min_latency == 5.0
+    assert limiter.limit == 2
+    assert (limiter.in_flight, limiter.rejected) == (0, 0)
+
+
+def test_adaptive_concurrency_coroutine():
+    limiter = contrib.AdaptiveConcurrency(initial_limit=2, max_limit=2)
+
+    @limiter
+    async def call(key):
+        await asyncio.sleep(0.01)
+        return key
+
+    async def main():
+        return await asyncio.gather(call(1), call(2), call(3), return_exceptions=True)
+
+    one, two, three = asyncio.run(main())
+    assert (one, two) == (1, 2)
+    assert isinstance(three, contrib.BulkheadFullError)
+    assert limiter.rejected == 1
+    assert limiter.latency >= 0.01
+
+    @limiter
+    async def call_many(keys):
+        return await asyncio.gather(*(call(key) for key in keys), return_exceptions=True)
+
+    one, two = asyncio.run(call_many([1, 2]))
+    assert one == 1
+    assert isinstance(two, contrib.BulkheadFullError)  # the child tasks don't inherit the parent's slot
+    assert limiter.rejected == 2
+    assert (limiter.in_flight, limiter.holders) == (0, set())
+
+    def gen():
+        yield
+
+    pytest.raises(TypeError, limiter, gen)
+
+
+def test_offload():
+    request_id = contextvars.ContextVar('request_id')
+
+    @contrib.offload(executor=ThreadPoolExecutor(1))
+    def blocking(value):
+        time.sleep(0.01)
+        return request_id.get(), value, threading.get_ident()
+
+    async def main():
+        request_id.set('abc')
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.001)
+
+        task = asyncio.ensure_future(ticker())
+        result = await blocking(1)
+        task.cancel()
+        return result, ticks
+
+    (context_value, value, ident), ticks = asyncio.run(main())
+    assert (context_value, value) == ('abc', 1)
+    assert ident != threading.get_ident()
+    assert len(ticks) > 1
+
+    async def coro():
+        pass
+
+    pytest.raises(TypeError, contrib.offload, coro)
+
+
+def test_offload_only_in_loop():
+    @contrib.offload(only_in_loop=True)
+    def blocking():
+        return threading.get_ident()
+
+    assert blocking() == threading.get_ident()
+
+    async def main():
+        future = blocking()
+        assert isinstance(future, asyncio.Future)
+        return await future
+
+    assert asyncio.run(main()) != threading.get_ident()
+
+
+def test_offload_process_pool():
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        child = executor.submit(os.getpid).result()  # multiprocessing uses os.getpid, start the worker before weaving
+        with aspectlib.weave('os.getpid', contrib.offload(executor=executor)):
+            assert asyncio.run(os.getpid()) == child
+    assert os.getpid() != child
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason="Needs os.register_at_fork")
+def test_after_fork():
+    budget = contrib.RetryBudget()
+    breaker = contrib.CircuitBreaker()
+    cache = contrib.Cache()
+    single_flight = contrib.SingleFlight()
+    batch = contrib.MicroBatch(lambda keys: keys, delay=0)
+    bulkhead = contrib.Bulkhead(max_concurrent=1)
+    release = threading.Event()
+
+    @bulkhead
+    def limited():
+        release.wait(5)
+        return 'limited'
+
+    functions = [breaker(lambda: 'breaker'), cache(lambda: 'cache'), single_flight(lambda: 'flight'), batch(lambda key: None)]
+    thread = threading.Thread(target=limited)
+    thread.start()
+    for _ in range(5000):
+        if bulkhead.in_flight:
+            break
+        time.sleep(0.001)
+    locks = [budget.lock, breaker.lock, cache.lock, single_flight.lock, batch.lock]
+    for lock in locks:
+        lock.acquire()  # as if other threads were using them at fork time
+    try:
+        pid = os.fork()
+        if not pid:
+            try:
+                signal.alarm(5)
+                release.set()
+                results = [budget.acquire(), limited()] + [function() for function in functions[:3]] + [functions[3]('batch')]
+                os._exit(0 if results == [True, 'limited', 'breaker', 'cache', 'flight', 'batch'] and bulkhead.in_flight == 0 else 1)
+            finally:
+                os._exit(2)
+    finally:
+        for lock in locks:
+            lock.release()
+        release.set()
+        thread.join()
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
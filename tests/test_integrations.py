@@ -1,8 +1,10 @@
 import asyncio
+import multiprocessing
 import os
 import re
 import socket
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
 
 import pytest
@@ -183,6 +185,103 @@ def test_decorate_asyncio_coroutine():
     assert 'coro => %r' % 'result' in output
 
 
+def test_timing_asyncio_coroutine():
+    buf = StringIO()
+    timed = debug.log(print_to=buf, module=False, stacktrace=False, timing=True)
+
+    @timed
+    async def coro():
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(coro())
+    finally:
+        loop.close()
+    assert re.search(r'coro => result \(\d+\.\dms\)', buf.getvalue())
+    (histogram,) = timed.histograms().values()
+    assert histogram.count == 1
+    assert histogram.min >= 10000000
+
+
+def test_trace_asyncio_tasks():
+    buf = StringIO()
+    traced = debug.log(print_to=buf, module=False, stacktrace=False, trace=True)
+
+    @traced
+    async def child(n):
+        await asyncio.sleep(0.01 * n)
+        return n
+
+    @traced
+    async def parent():
+        return await asyncio.gather(child(1), child(2))
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(parent()) == [1, 2]
+    finally:
+        loop.close()
+    lines = buf.getvalue().splitlines()
+    assert lines[0] == 'parent()'
+    assert sorted(lines[1:3]) == ['  child(1)', '  child(2)']
+    assert lines[3].startswith('  child => 1 (')
+    assert lines[4].startswith('  child => 2 (')
+    assert lines[5].startswith('parent => [1, 2] (')
+
+
+@pytest.mark.skipif(not hasattr(asyncio, 'timeout'), reason="asyncio.timeout not available")
+def test_trace_asyncio_cancelled():
+    buf = StringIO()
+    traced = debug.log(print_to=buf, module=False, stacktrace=False, trace=True, timing=True)
+
+    @traced
+    async def slow():
+        await asyncio.sleep(1)
+
+    @traced
+    async def fast():
+        return 'fast'
+
+    async def main():
+        with pytest.raises(TimeoutError):
+            async with asyncio.timeout(0.01):
+                await slow()
+        return await fast()
+
+    assert asyncio.run(main()) == 'fast'
+    lines = buf.getvalue().splitlines()
+    assert lines[0] == 'slow()'
+    assert lines[1] == 'fast()'
+    assert lines[2].startswith('fast => fast (')
+    assert sorted(histogram.count for histogram in traced.histograms().values()) == [1, 1]
+
+
+def test_aspect_outermost_asyncio_coroutine():
+    calls = []
+
+    @aspectlib.Aspect(outermost=True)
+    def aspect(n):
+        calls.append(n)
+        yield
+
+    @aspect
+    async def countdown(n):
+        await asyncio.sleep(0)
+        return await countdown(n - 1) if n else 'done'
+
+    async def main():
+        return await asyncio.gather(countdown(2), countdown(3))
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(main()) == ['done', 'done']
+    finally:
+        loop.close()
+    assert sorted(calls) == [2, 3]
+
+
 def test_decorate_tornado_coroutine():
     buf = StringIO()
 
@@ -205,3 +304,77 @@ def test_decorate_tornado_coroutine():
         asyncio.get_event_loop = get_event_loop
     output = buf.getvalue()
     assert 'coro => %r' % 'result' in output
+
+
+def woven_by_plan():
+    return mock('woven')
+
+
+def wrapping_by_plan():
+    def wrapper(func):
+        def wrapped(*args, **kwargs):
+            return [func(*args, **kwargs)]
+
+        return wrapped
+
+    return wrapper
+
+
+def call_test_mod_target():
+    from test_pkg1.test_pkg2 import test_mod
+
+    return test_mod.target()
+
+
+def weave_plan_initializer(arg):
+    os.environ['WEAVE_PLAN_INITIALIZER'] = arg
+
+
+def call_and_check_initializer():
+    return call_test_mod_target(), os.environ.get('WEAVE_PLAN_INITIALIZER')
+
+
+@pytest.mark.parametrize('method', ['spawn', 'fork'])
+def test_weave_plan_process_pool_executor(method):
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip('Start method %r not available' % method)
+    plan = aspectlib.WeavePlan()
+    with plan.weave('test_pkg1.test_pkg2.test_mod.target', wrapping_by_plan):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context(method), **plan.pool_options()) as executor:
+            assert executor.submit(call_test_mod_target).result() == [None]
+        assert call_test_mod_target() == [None]
+        with plan.apply():
+            assert call_test_mod_target() == [None]
+    assert plan.weaves == []
+    assert call_test_mod_target() is None
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="fork start method not available")
+def test_weave_plan_fork_dropped_weave():
+    plan = aspectlib.WeavePlan()
+    with plan.weave('test_pkg1.test_pkg2.test_mod.target', wrapping_by_plan, after_fork='drop'):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork'), **plan.pool_options()) as executor:
+            assert executor.submit(call_test_mod_target).result() == [None]
+    assert call_test_mod_target() is None
+
+
+def test_weave_plan_multiprocessing_pool():
+    plan = aspectlib.WeavePlan([('test_pkg1.test_pkg2.test_mod.target', woven_by_plan, {})])
+    with multiprocessing.get_context('spawn').Pool(1, **plan.pool_options(weave_plan_initializer, ('initialized',))) as pool:
+        assert pool.apply(call_and_check_initializer) == ('woven', 'initialized')
+    assert call_test_mod_target() is None
+
+
+def test_weave_plan_unexportable():
+    from test_pkg1.test_pkg2 import test_mod
+
+    def local_func():
+        pass
+
+    plan = aspectlib.WeavePlan()
+    pytest.raises(TypeError, plan.weave, local_func, woven_by_plan)
+    pytest.raises(TypeError, plan.weave, 'test_pkg1.test_pkg2.test_mod'.split, woven_by_plan)
+    with plan.weave(test_mod.func, woven_by_plan):
+        assert test_mod.func() == 'woven'
+        assert plan.weaves == [('test_pkg1.test_pkg2.test_mod.func', woven_by_plan, {})]
+    assert test_mod.func() is None